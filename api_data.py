@@ -1,9 +1,33 @@
 import glob
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
+import numpy as np
 import pandas as pd
-import requests
+
+from child_tables import child_tables, concat_with_child_tables, length_column, link_child_table, offset_column, \
+    with_child_tables
+from constants import ColumnNames
+from derived import derive_columns, derived_inputs
+from downloader import Download, Downloader
+from instrumentation import RunReport, file_size
+from pipeline import Node, Pipeline, code_version
+from schema import apply_schema, memory_usage, read_csv_dtypes
+from storage import apply_filters, get_storage
+
+CSV_CHUNK_SIZE = 1 << 18
+# Merged partitions are sorted by year and then by cell of this many degrees, so each row group of a columnar storage
+# covers few years and a small area, and its statistics let year and bbox predicates skip the others.
+SORT_CELL_INTERVAL = 1
+# Modules the processing stages of every source run. Their code, and that of ApiDataInterface.code_dependencies, is
+# part of each stage's fingerprint; editing anything else, like the tile or viewer code, leaves the stages up to date.
+PROCESSING_MODULES = ['api_data', 'child_tables', 'derived', 'schema', 'storage']
+# Aggregate joins add a `{table}` column holding the row count, or a `{table}_{column}` column per declared column
+# holding its sum or max, with 0 for crashes without rows.
+AGGREGATE_JOINS = ['count', 'sum', 'max']
 
 
 @dataclass
@@ -11,6 +35,19 @@ class Table:
     name: str
     columns: list
     url: str = None
+    # Source columns read only to derive other columns in add_columns.
+    input_columns: list = None
+    # Columns computed from others in add_columns, as {column: expression} (see derived.py). Their inputs are read from
+    # the source even when not listed in columns, and they may depend on each other in any order.
+    derived: dict = None
+    # Target dtype of each column (see schema.py), applied while reading the source and in convert_data_types.
+    dtypes: dict = None
+    # (column, op, value) tuples rows must match; applied to each chunk while reading the source.
+    filters: list = None
+    # How merge_data attaches a child table to the crash table: 'columnar' keeps its rows in a separate table located
+    # by per-crash offset/length columns, 'records' stores a list of dicts per crash, and 'count', 'sum' or 'max'
+    # reduce its rows to one value per crash (see AGGREGATE_JOINS).
+    join: str = 'columnar'
 
 
 @dataclass
@@ -31,10 +68,14 @@ class DataSources:
 
 
 class ApiDataInterface:
-    def __init__(self, entity, tables: Tables):
+    def __init__(self, entity, tables: Tables, storage=None, column_names: ColumnNames = None,
+                 report: RunReport = None):
         self.entity = entity
         self.tables = tables
         self.key_columns = self.tables.key_columns
+        self.column_names = column_names or ColumnNames()
+        self.storage = get_storage(storage) if storage is None or isinstance(storage, str) else storage
+        self.report = report or RunReport()
 
     def data_dir(self):
         return f'data.nosync/{self.entity}'
@@ -43,87 +84,323 @@ class ApiDataInterface:
         return f'{self.data_dir()}/{dataset_name.lower()}.csv'
 
     def unfiltered_data_file(self, dataset_name, year):
-        return f'{self.data_dir()}/{dataset_name}-{year}.pkl'
+        return f'{self.data_dir()}/{dataset_name}-{year}{self.storage.suffix}'
 
     def filtered_data_file(self, dataset_name, year):
-        return f'{self.data_dir()}/{dataset_name}-{year}-filtered.pkl'
+        return f'{self.data_dir()}/{dataset_name}-{year}-filtered{self.storage.suffix}'
 
     def merged_data_file(self, year):
-        return f'{self.data_dir()}/data-{year}.pkl'
+        return f'{self.data_dir()}/data-{year}{self.storage.suffix}'
+
+    @staticmethod
+    def child_data_file(table_name, merged_file):
+        return os.path.join(os.path.dirname(merged_file), table_name, os.path.basename(merged_file))
+
+    @staticmethod
+    def partition_stats_file(merged_file):
+        return f'{merged_file}.stats.json'
+
+    def downloads(self):
+        return [Download(url=table.url, path=self.downloaded_data_file(table.name))
+                for table in self.tables.get_tables() if table.url]
 
-    def download_data(self, refresh=False):
+    def download_data(self, refresh=False, max_workers=4):
         if not os.path.exists(self.data_dir()):
             os.makedirs(self.data_dir())
-        for table in self.tables.get_tables():
-            if not table.url:
-                continue
-            output_path = self.downloaded_data_file(table.name)
-            if not refresh and os.path.exists(output_path):
-                continue
-            response = requests.get(table.url)
-            response.encoding = 'utf-8-sig'
-            with open(output_path, 'w') as outfile:
-                outfile.write(response.text)
+        Downloader(max_workers=max_workers).download_all(self.downloads(), refresh=refresh)
+
+    # Counts the bytes the storage actually read, which projection and pushdown can make much less than the file.
+    def read_df(self, path, columns: list = None, filters: list = None):
+        df, bytes_read = self.storage.read_counted(path, columns=columns, filters=filters)
+        self.report.count(bytes_read=bytes_read)
+        return df
+
+    def write_df(self, df, path):
+        self.storage.write(df, path)
+        self.report.count(bytes_written=file_size(path))
+
+    def source_columns(self, table: Table):
+        derived = [c for c in derived_inputs(table.derived or {}) if c not in table.columns]
+        return self.key_columns + table.columns + (table.input_columns or []) + derived
+
+    def read_csv(self, path, table: Table, chunk_size=CSV_CHUNK_SIZE):
+        wanted = set(self.source_columns(table))
+        usecols = [c for c in pd.read_csv(path, nrows=0).columns if c.upper() in wanted]
+        read_dtypes = read_csv_dtypes(table.dtypes or {})
+        dtypes = {c: read_dtypes[c.upper()] for c in usecols if c.upper() in read_dtypes}
+        chunks = []
+        for chunk in pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=chunk_size):
+            chunk.columns = [c.upper() for c in chunk.columns]
+            rows = len(chunk)
+            if table.filters:
+                chunk = apply_filters(chunk, table.filters)
+            self.report.count(rows_in=rows, rows_out=len(chunk))
+            chunks.append(chunk)
+        self.report.count(bytes_read=file_size(path))
+        return pd.concat(chunks, ignore_index=True)
 
     def convert_to_df(self):
         for table in self.tables.get_tables():
-            df = pd.read_csv(self.downloaded_data_file(table.name))
-            df.to_pickle(self.unfiltered_data_file(table.name, year='all'))
+            df = self.read_csv(self.downloaded_data_file(table.name), table)
+            self.write_df(df, self.unfiltered_data_file(table.name, year='all'))
 
-    def convert_data_types(self, df, dataset: Table = None) -> None:
-        return
+    def convert_data_types(self, df, dataset: Table = None):
+        return apply_schema(df, dataset.dtypes or {})
 
     def add_columns(self, df, dataset: Table) -> None:
+        return derive_columns(df, dataset.derived) if dataset.derived else df
+
+    # Columns of a child table that depend on its crash; `crash_df` is the filtered crash table indexed by key columns.
+    def add_child_columns(self, crash_df, df, dataset: Table):
         return df
 
     def filter_columns(self, df, dataset: Table):
         return df[self.key_columns + dataset.columns]
 
     def filter_rows(self, df, dataset: Table = None):
-        return df
+        return apply_filters(df, dataset.filters) if dataset and dataset.filters else df
 
     def filter_data(self, year):
         for dataset in self.tables.get_tables():
             dataset_name = dataset.name
-            df = pd.read_pickle(self.unfiltered_data_file(dataset_name, year))
-            df.columns = [c.upper() for c in df.columns]
-            self.convert_data_types(df, dataset)
-            df = self.add_columns(df, dataset)
-            df = self.filter_columns(df, dataset)
-            df = self.filter_rows(df, dataset)
-            df.to_pickle(self.filtered_data_file(dataset_name, year))
+            with self.report.stage(f'{self.entity}/filter/{year}/{dataset_name}'):
+                df = self.read_df(self.unfiltered_data_file(dataset_name, year))
+                df.columns = [c.upper() for c in df.columns]
+                self.report.count(rows_in=len(df))
+                size = memory_usage(df)
+                df = self.convert_data_types(df, dataset)
+                print(f'{dataset_name}: {size / 2 ** 20:.1f} MiB -> {memory_usage(df) / 2 ** 20:.1f} MiB after '
+                      f'converting data types')
+                df = self.add_columns(df, dataset)
+                # Rows first, so filters can use derived and input columns that filter_columns drops.
+                df = self.filter_rows(df, dataset)
+                df = self.filter_columns(df, dataset)
+                self.report.count(rows_out=len(df))
+                self.write_df(df, self.filtered_data_file(dataset_name, year))
+
+    def aggregate(self, df, table: Table, index):
+        grouped = df.groupby(self.key_columns)
+        if table.join == 'count':
+            return {table.name: grouped.size().reindex(index, fill_value=0).to_numpy()}
+        reduced = grouped[table.columns].agg(table.join).reindex(index, fill_value=0)
+        return {f'{table.name}_{column}': reduced[column].to_numpy() for column in table.columns}
 
     def merge_data(self, year):
-        crash_df = pd.read_pickle(self.filtered_data_file(self.tables.crash.name, year))
+        crash_df = self.read_df(self.filtered_data_file(self.tables.crash.name, year),
+                                columns=self.key_columns + self.tables.crash.columns)
         crash_df.columns = [c.upper() for c in crash_df.columns]
+        self.report.count(rows_in=len(crash_df))
         crash_df = crash_df.set_index(self.key_columns, drop=True)
 
         merged_df = crash_df
+        children = {}
 
         for other_table in self.tables.get_tables():
-            if not other_table or other_table.name == 'Crash':
+            if other_table is self.tables.crash:
+                continue
+            other_df = self.read_df(self.filtered_data_file(other_table.name, year),
+                                    columns=self.key_columns + other_table.columns)
+            self.report.count(rows_in=len(other_df))
+            other_df = self.add_child_columns(crash_df, other_df, other_table)
+            if other_table.join == 'columnar':
+                merged_df, children[other_table.name] = link_child_table(merged_df, other_df, self.key_columns,
+                                                                         other_table.name)
+                continue
+            if other_table.join in AGGREGATE_JOINS:
+                merged_df = merged_df.assign(**self.aggregate(other_df, other_table, merged_df.index))
                 continue
-            other_df = pd.read_pickle(self.filtered_data_file(other_table.name, year))
-            other_df = other_df.groupby(self.key_columns)[other_df.columns.difference(self.key_columns)].apply(lambda x: x.to_dict('r'))
+            other_df = other_df.groupby(self.key_columns)[other_df.columns.difference(self.key_columns)].apply(
+                lambda x: x.to_dict('records'))
             merged_df = merged_df.merge(other_df.rename(other_table.name), how='left', left_index=True, right_index=True)
 
-        merged_df.to_pickle(self.merged_data_file(year))
-
-    def process_data(self, year='all'):
-        print('Downloading data...')
-        self.download_data(refresh=False)
-        print('Converting to df...')
-        self.convert_to_df()
-        print('Filtering...')
-        self.filter_data(year)
-        print('Merging...')
-        self.merge_data(year)
-        print('Done.')
-
-    def read_data(self):
-        all_pickles = glob.glob(self.merged_data_file('*'))
-        dfs = []
-        for filename_geojson in all_pickles:
-            df = pd.read_pickle(filename_geojson)
-            dfs.append(df)
+        merged_file = self.merged_data_file(year)
+        merged_df = self.sort_partition(merged_df)
+        self.write_df(merged_df, merged_file)
+        self.report.count(rows_out=len(merged_df))
+        for name, child_df in children.items():
+            os.makedirs(os.path.dirname(self.child_data_file(name, merged_file)), exist_ok=True)
+            self.write_df(child_df, self.child_data_file(name, merged_file))
+        with open(self.partition_stats_file(merged_file), 'w') as outfile:
+            json.dump(self.partition_stats(merged_df), outfile)
+
+    def predicate_columns(self):
+        return {'year': self.column_names.year, 'latitude': self.column_names.latitude,
+                'longitude': self.column_names.longitude}
+
+    @staticmethod
+    def predicate_values(df, column):
+        if column in df.columns:
+            return pd.to_numeric(df[column], errors='coerce')
+        if column in df.index.names:
+            return pd.to_numeric(pd.Series(df.index.get_level_values(column)), errors='coerce')
+        return None
+
+    # Value ranges of the predicate columns, so read_data can skip partitions without opening them.
+    def partition_stats(self, df):
+        stats = {'rows': len(df)}
+        for key, column in self.predicate_columns().items():
+            values = self.predicate_values(df, column)
+            if values is not None and values.notnull().any():
+                stats[key] = [float(values.min()), float(values.max())]
+        return stats
+
+    # Rows in order of year, then of SORT_CELL_INTERVAL cell. Child tables stay as they are: offsets are per crash row,
+    # so they still point at each crash's children.
+    def sort_partition(self, df):
+        keys = []
+        for key, column in self.predicate_columns().items():
+            values = self.predicate_values(df, column)
+            if values is not None:
+                values = values.to_numpy(dtype=float)
+                keys.append(values if key == 'year' else np.floor(values / SORT_CELL_INTERVAL))
+        # lexsort sorts by its last key first, and keeps the source order among equal keys.
+        return df.iloc[np.lexsort(keys[::-1])] if keys else df
+
+    # `years` is an inclusive (first, last) pair and `bbox` is (min_longitude, min_latitude, max_longitude,
+    # max_latitude).
+    def predicate_ranges(self, years=None, bbox=None):
+        ranges = {}
+        if years is not None:
+            ranges['year'] = years
+        if bbox is not None:
+            ranges['longitude'] = (bbox[0], bbox[2])
+            ranges['latitude'] = (bbox[1], bbox[3])
+        return ranges
+
+    def partition_year(self, merged_file):
+        prefix, suffix = self.merged_data_file('*').split('*')
+        year = merged_file[len(prefix):len(merged_file) - len(suffix)]
+        return int(year) if year.isdigit() else None
+
+    def may_match(self, merged_file, ranges):
+        try:
+            with open(self.partition_stats_file(merged_file)) as infile:
+                stats = json.load(infile)
+        except (IOError, ValueError):
+            stats = {}
+        year = self.partition_year(merged_file)
+        if 'year' not in stats and year is not None:
+            stats['year'] = [year, year]
+        return all(key not in stats or (stats[key][0] <= high and stats[key][1] >= low)
+                   for key, (low, high) in ranges.items())
+
+    # Code of the source that its processing stages run besides PROCESSING_MODULES: its interface classes, and the
+    # module-level functions they call, which sources add by overriding this.
+    def code_dependencies(self):
+        return [cls for cls in type(self).__mro__ if cls not in (ApiDataInterface, object)]
+
+    # Files convert_to_df reads.
+    def source_files(self):
+        return [d.path for d in self.downloads()]
+
+    # Years convert_to_df writes a partition for.
+    def pipeline_years(self):
+        return ['all']
+
+    # Whether convert_to_df(years) and source_files(years) can handle a subset of the years. Each year is then
+    # converted by its own node, so its filter and merge don't wait for the other years.
+    def converts_by_year(self):
+        return False
+
+    def merged_files(self, year):
+        merged_file = self.merged_data_file(year)
+        return [merged_file, self.partition_stats_file(merged_file)] + [
+            self.child_data_file(t.name, merged_file) for t in self.tables.get_tables()
+            if t is not self.tables.crash and t.join == 'columnar']
+
+    # The download, convert, filter and merge stages as pipeline nodes, filtering and merging each year separately, and
+    # a last node checking that every year's partition was written.
+    def pipeline_nodes(self, years=None):
+        years = self.pipeline_years() if years is None else years
+        tables = self.tables.get_tables()
+        params = {'tables': repr(self.tables), 'storage': type(self.storage).__name__,
+                  'code': code_version(*[sys.modules[m] for m in PROCESSING_MODULES], *self.code_dependencies())}
+        downloads = self.downloads()
+        nodes = []
+        if downloads:
+            # Downloads are skipped when their file exists, so this only runs if one is missing.
+            nodes.append(Node(name=f'{self.entity}/download', function=self.download_data,
+                              outputs=[d.path for d in downloads],
+                              params={'urls': [(d.url, d.params) for d in downloads]}))
+        dependencies = [n.name for n in nodes]
+        if self.converts_by_year():
+            converts = {year: Node(name=f'{self.entity}/convert/{year}', function=self.convert_to_df, args=([year],),
+                                   inputs=self.source_files([year]),
+                                   outputs=[self.unfiltered_data_file(t.name, year) for t in tables],
+                                   dependencies=dependencies, params=params) for year in years}
+        else:
+            outputs = [self.unfiltered_data_file(t.name, y) for t in tables for y in self.pipeline_years()]
+            convert = Node(name=f'{self.entity}/convert', function=self.convert_to_df, inputs=self.source_files(),
+                           outputs=outputs, dependencies=dependencies, params=params)
+            converts = {year: convert for year in years}
+        nodes += list({node.name: node for node in converts.values()}.values())
+        for year in years:
+            nodes.append(Node(name=f'{self.entity}/filter/{year}', function=self.filter_data, args=(year,),
+                              inputs=[self.unfiltered_data_file(t.name, year) for t in tables],
+                              outputs=[self.filtered_data_file(t.name, year) for t in tables],
+                              dependencies=[converts[year].name], params=params))
+            nodes.append(Node(name=f'{self.entity}/merge/{year}', function=self.merge_data, args=(year,),
+                              inputs=[self.filtered_data_file(t.name, year) for t in tables],
+                              outputs=self.merged_files(year), dependencies=[f'{self.entity}/filter/{year}'],
+                              params=params))
+        nodes.append(Node(name=f'{self.entity}/validate', function=self.validate_partitions, args=(years,),
+                          inputs=[f for year in years for f in self.merged_files(year)],
+                          dependencies=[f'{self.entity}/merge/{year}' for year in years], params=params))
+        return nodes
+
+    # Checks that every one of `years` has a merged partition holding only that year's crashes.
+    def validate_partitions(self, years):
+        problems = []
+        for year in years:
+            merged_file = self.merged_data_file(year)
+            try:
+                with open(self.partition_stats_file(merged_file)) as infile:
+                    stats = json.load(infile)
+            except (IOError, ValueError):
+                problems.append(f'{year}: no partition at {merged_file}')
+                continue
+            self.report.count(rows_in=stats.get('rows', 0))
+            year_range = stats.get('year')
+            if self.partition_year(merged_file) is not None and year_range and year_range != [year, year]:
+                problems.append(f'{year}: partition holds years {year_range[0]:.0f} to {year_range[1]:.0f}')
+        if problems:
+            raise ValueError(f'Invalid {self.entity} partitions: {"; ".join(problems)}')
+        extra = sorted(set(glob.glob(self.merged_data_file('*'))) - {self.merged_data_file(year) for year in years})
+        if extra:
+            print(f'{self.entity}: partitions {", ".join(extra)} are not among the expected years')
+
+    # Runs the stages that are out of date for `year` (every year by default), independent ones in parallel, and
+    # writes their metrics to `report_file` if given.
+    def process_data(self, year=None, workers: int = None, force: bool = False, report_file: str = None):
+        Pipeline(workers=workers, report=self.report).run(self.pipeline_nodes(None if year is None else [year]),
+                                                          force=force)
+        print(self.report.summary())
+        if report_file:
+            self.report.write(report_file)
+
+    def read_partition(self, filename, columnar, columns: list = None, filters: list = None):
+        df = self.read_df(filename, columns=columns, filters=filters)
+        # Filters drop crash rows but leave the child tables whole; offsets still point into them.
+        return with_child_tables(df, {name: self.read_df(self.child_data_file(name, filename))
+                                      for name in columnar if length_column(name) in df.columns})
+
+    # Partitions whose stats rule out `years` or `bbox` aren't opened; the rest are read in parallel, with `columns`,
+    # `filters` and the predicates pushed down to the storage.
+    def read_data(self, columns: list = None, filters: list = None, years=None, bbox=None, workers: int = 4):
+        columnar = [t.name for t in self.tables.get_tables() if t is not self.tables.crash and t.join == 'columnar']
+        if columns is not None:
+            columns = columns + [c for name in columnar for c in (offset_column(name), length_column(name))]
+        ranges = self.predicate_ranges(years, bbox)
+        partitions = [f for f in sorted(glob.glob(self.merged_data_file('*'))) if self.may_match(f, ranges)]
+        if not partitions:
+            raise ValueError(f'No {self.entity} data matches years={years} bbox={bbox}')
+        predicate_columns = self.predicate_columns()
+        filters = (filters or []) + [(predicate_columns[key], op, value) for key, (low, high) in ranges.items()
+                                     for op, value in [('>=', low), ('<=', high)]]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            dfs = list(executor.map(lambda f: self.read_partition(f, columnar, columns, filters or None), partitions))
+        if len(dfs) == 1:
+            return dfs[0]
+        if any(child_tables(df) for df in dfs):
+            return concat_with_child_tables(dfs)
         return pd.concat(dfs, axis=0)
@@ -0,0 +1,149 @@
+import argparse
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+
+from downloader import BOM, Download, Downloader
+
+BODY = BOM + b'CASEYEAR,STATE,ST_CASE\n' + b''.join(b'2020,%d,%d\n' % (i % 56, i) for i in range(100000))
+
+
+def etag(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+# Stand-in for a source's HTTP server: serves `body` with an ETag, honours Range when If-Range (if sent) still matches,
+# answers 304 to a matching If-None-Match, and when `cut` is set sends only half of the next body before hanging up.
+class StandInServer(http.server.ThreadingHTTPServer):
+    def __init__(self, body):
+        super(StandInServer, self).__init__(('127.0.0.1', 0), StandInHandler)
+        self.body = body
+        self.cut = False
+        self.requests = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/data.csv'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        tag = etag(server.body)
+        server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == tag:
+            self.send_response(304)
+            self.send_header('ETag', tag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', tag) == tag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(server.body) - 1}/{len(server.body)}')
+        else:
+            self.send_response(200)
+        body = server.body[start:]
+        self.send_header('ETag', tag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.cut:
+            server.cut = False
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+def read(path):
+    with open(path, 'rb') as infile:
+        return infile.read()
+
+
+# An interrupted download leaves only its `.part` file, and the next one resumes it with a Range request from where
+# it stopped in the remote body (past the stripped BOM) and an If-Range of the ETag.
+def check_resume(server, downloader, directory):
+    download = Download(url=server.url, path=f'{directory}/resume.csv')
+    server.cut = True
+    try:
+        downloader.download(download)
+        return ['the interrupted download did not raise']
+    except Exception:
+        pass
+    problems = []
+    partial = downloader.partial_path(download.path)
+    if os.path.exists(download.path):
+        problems.append('the interrupted download was renamed into place')
+    if not os.path.exists(partial):
+        return problems + ['no .part file was left']
+    offset = os.path.getsize(partial)
+    server.requests.clear()
+    downloader.download(download)
+    request = server.requests[0]
+    if request.get('Range') != f'bytes={offset + len(BOM)}-' or request.get('If-Range') != etag(server.body):
+        problems.append(f'resumed with {request.get("Range")} and If-Range {request.get("If-Range")}')
+    if read(download.path) != server.body[len(BOM):]:
+        problems.append('the resumed file differs from the body')
+    return problems
+
+
+# A resource that changed since the interruption fails If-Range, so the server sends it whole and the download
+# starts over instead of appending to the old bytes.
+def check_restart(server, downloader, directory):
+    download = Download(url=server.url, path=f'{directory}/restart.csv')
+    server.cut = True
+    try:
+        downloader.download(download)
+    except Exception:
+        pass
+    server.body = server.body + b'2021,1,1\n'
+    downloader.download(download)
+    return [] if read(download.path) == server.body[len(BOM):] else ['the restarted file differs from the new body']
+
+
+# Refreshing an unchanged file sends If-None-Match and leaves the file as it is on a 304; a changed one is replaced.
+def check_revalidation(server, downloader, directory):
+    download = Download(url=server.url, path=f'{directory}/revalidate.csv')
+    downloader.download(download)
+    problems = []
+    server.requests.clear()
+    if downloader.download(download, refresh=True):
+        problems.append('an unchanged file was downloaded again')
+    if server.requests[0].get('If-None-Match') != etag(server.body):
+        problems.append(f'revalidated with If-None-Match {server.requests[0].get("If-None-Match")}')
+    server.body = server.body + b'2021,2,2\n'
+    if not downloader.download(download, refresh=True) or read(download.path) != server.body[len(BOM):]:
+        problems.append('a changed file was not replaced')
+    return problems
+
+
+CHECKS = {'resume': check_resume, 'restart': check_restart, 'revalidation': check_revalidation}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks resuming, restarting and revalidating downloads against a '
+                                                 'local stand-in HTTP server.')
+    parser.add_argument('--checks', nargs='*', default=list(CHECKS), choices=list(CHECKS))
+    args = parser.parse_args()
+
+    failed = False
+    for check_name in args.checks:
+        stand_in = StandInServer(BODY)
+        threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as scratch:
+            found = CHECKS[check_name](stand_in, Downloader(chunk_size=4096), scratch)
+        stand_in.shutdown()
+        stand_in.server_close()
+        print(f'{check_name}: ' + ('; '.join(found) if found else 'ok'))
+        failed |= bool(found)
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,141 @@
+import argparse
+import os
+import tempfile
+
+import pandas as pd
+
+from api_data import ApiDataInterface
+from benchmarks.stages import generator_for
+from benchmarks.synthetic import SOURCES, write_source
+from constants import UNKNOWN
+from maryland import CRASH_DATE_COLUMN, DATE_OF_BIRTH_COLUMN, age, ages, parse_date, parse_dates
+from web_data import WEB_BASE_DIR
+
+# Ways of writing the same tiles. The row-by-row path is the reference; it only writes JSON tiles.
+VARIANTS = {
+    'batch': {'batch': True},
+    'incremental': {'batch': True, 'incremental': True},
+    'workers': {'batch': True, 'workers': 2},
+}
+
+# Maryland dates in the formats and with the odd values the source has, besides the synthetic data's, as read_csv and
+# the schema leave them.
+DATE_SAMPLES = ['20150704', '20150704.0', '20150704 00:00:00', '20150704 ', '04-JUL-15', '04-Jul-15', '29-FEB-16',
+                '31-DEC-99', '1/1/1900', '', 'nan', '2015-07-04', '20151304']
+
+
+def read_tiles(directory):
+    tiles = {}
+    for path, _, filenames in os.walk(directory):
+        for filename in filenames:
+            # Tiles and the detail shards in their `data-*-details` directories.
+            relpath = os.path.relpath(os.path.join(path, filename), directory)
+            if relpath.startswith('data-') and filename.endswith('.json'):
+                with open(os.path.join(path, filename), 'rb') as infile:
+                    tiles[relpath] = infile.read()
+    return tiles
+
+
+def write_tiles(name, df, options):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            # The row-by-row path writes neither binary tiles nor pyramid levels, so no variant does.
+            generator = generator_for(name, binary_tiles=False, pyramid=None)
+            generator.iterate_and_save(df, latlong_interval=SOURCES[name].latlong_interval, **options)
+            return read_tiles(f'{WEB_BASE_DIR}/{generator.data_dir}')
+        finally:
+            os.chdir(cwd)
+
+
+def different_files(expected: dict, actual: dict):
+    return sorted((expected.keys() ^ actual.keys()) | {f for f in expected.keys() & actual.keys()
+                                                       if expected[f] != actual[f]})
+
+
+# Checks that every variant writes byte-for-byte the same tile JSON as the row-by-row implementation.
+def check_source(name, crashes, seed=0):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api = write_source(name, crashes, seed)
+            for node in api.pipeline_nodes():
+                if not node.name.endswith('/download'):
+                    node.function(*node.args)
+            df = api.read_data()
+        finally:
+            os.chdir(cwd)
+    expected = write_tiles(name, df, {'batch': False})
+    return {variant: different_files(expected, write_tiles(name, df, options)) for variant, options in VARIANTS.items()}
+
+
+# Values a bulk conversion reads differently from the per-value function it replaces. A ValueError from the function
+# counts as UNKNOWN, like the NaT or NA the bulk conversion gives.
+def mismatches(converted: pd.Series, inputs: list, function):
+    found = []
+    for position in range(len(converted)):
+        args = [values.iloc[position] for values in inputs]
+        try:
+            expected = function(*args)
+        except ValueError:
+            expected = UNKNOWN
+        actual = converted.iloc[position]
+        if (UNKNOWN if pd.isnull(actual) else actual) != expected:
+            found.append(f'{args} -> {actual}, expected {expected}')
+    return found
+
+
+# Checks that Maryland's bulk parse_dates and ages read every date of the synthetic source, and of DATE_SAMPLES, the
+# same as parse_date and age.
+def check_maryland_dates(crashes, seed=0):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api = write_source('maryland', crashes, seed)
+            api.convert_to_df()
+            # The dates as convert_data_types gets them, before Maryland's override parses them.
+            crash_df, person_df = [
+                ApiDataInterface.convert_data_types(api, api.read_df(api.unfiltered_data_file(t.name, 'all')), t)
+                for t in [api.tables.crash, api.tables.person]]
+        finally:
+            os.chdir(cwd)
+    samples = pd.Series(DATE_SAMPLES, dtype=object)
+    found = []
+    for dates in [crash_df[CRASH_DATE_COLUMN], person_df[DATE_OF_BIRTH_COLUMN], samples]:
+        dates = dates.reset_index(drop=True)
+        found += mismatches(parse_dates(dates), [dates], parse_date)
+    # Each person's age at their crash, and at every pairing of the samples.
+    key = api.key_columns[0]
+    crash_dates = parse_dates(crash_df.set_index(key)[CRASH_DATE_COLUMN]).reindex(person_df[key])
+    pairs = [(parse_dates(person_df[DATE_OF_BIRTH_COLUMN]), crash_dates),
+             (parse_dates(samples.repeat(len(samples))), parse_dates(pd.concat([samples] * len(samples))))]
+    for birth_dates, dates in pairs:
+        birth_dates, dates = birth_dates.reset_index(drop=True), dates.reset_index(drop=True)
+        found += mismatches(ages(birth_dates, dates), [birth_dates, dates], age)
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that the optimized tile paths write the same JSON as the '
+                                                 'row-by-row implementation, and Maryland\'s bulk date parsing '
+                                                 'matches the per-value one.')
+    parser.add_argument('--sources', nargs='*', default=list(SOURCES), choices=list(SOURCES))
+    parser.add_argument('--crashes', type=int, default=2000)
+    args = parser.parse_args()
+
+    failed = False
+    for source_name in args.sources:
+        for variant, different in check_source(source_name, args.crashes).items():
+            print(f'{source_name} {variant}: ' + (f'{len(different)} files differ, e.g. {different[:3]}'
+                                                  if different else 'identical'))
+            failed |= bool(different)
+    if 'maryland' in args.sources:
+        different = check_maryland_dates(args.crashes)
+        print('maryland dates and ages: ' + (f'{len(different)} values differ, e.g. {different[:3]}'
+                                             if different else 'identical'))
+        failed |= bool(different)
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,53 @@
+import argparse
+import io
+import json
+import random
+import timeit
+
+import geojson
+
+from web_data import write_point_features
+
+HARMS = ['car', 'ped', 'bike', 'other']
+
+
+def fars_sized_tile(num_features, seed=0):
+    r = random.Random(seed)
+    return {
+        'longitude': [r.uniform(-78, -76) for _ in range(num_features)],
+        'latitude': [r.uniform(38, 40) for _ in range(num_features)],
+        'id': [f'{r.randint(2010, 2021)}-{r.randint(1, 56)}-{r.randint(10000, 560000)}' for _ in range(num_features)],
+        'year': [r.randint(2010, 2021) for _ in range(num_features)],
+        'harm': [r.choice(HARMS) for _ in range(num_features)],
+        'num_fatalities': [r.choice([1, 1, 1, 2, 3]) for _ in range(num_features)],
+    }
+
+
+def with_geojson(tile):
+    features = [
+        geojson.Feature(geometry=geojson.Point((longitude, latitude)),
+                        properties={'id': item_id, 'year': year, 'harm': harm, 'num_fatalities': num_fatalities})
+        for longitude, latitude, item_id, year, harm, num_fatalities in zip(*tile.values())]
+    outfile = io.StringIO()
+    json.dump(geojson.FeatureCollection(features=features), outfile)
+    return outfile.getvalue()
+
+
+def with_writer(tile):
+    outfile = io.StringIO()
+    write_point_features(outfile, tile['longitude'], tile['latitude'],
+                         {k: v for k, v in tile.items() if k not in ('longitude', 'latitude')})
+    return outfile.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the streaming GeoJSON writer with geojson + json.dump.')
+    parser.add_argument('--features', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tile = fars_sized_tile(args.features)
+    assert with_geojson(tile) == with_writer(tile), 'Writer output differs from geojson + json.dump'
+    for name, fn in [('geojson + json.dump', with_geojson), ('write_point_features', with_writer)]:
+        best = min(timeit.repeat(lambda: fn(tile), number=1, repeat=args.repeat))
+        print(f'{name:>22}: {best * 1000:8.1f} ms for {args.features} features')
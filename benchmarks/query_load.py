@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import SOURCES, write_source
+from query_service import DEFAULT_CACHE_BYTES, DEFAULT_CELL_SIZE, QueryService, load_index
+from web_data import HARM_CATEGORIES
+
+
+def build_indexes(sources, crashes, cell_size, seed=0):
+    indexes = {}
+    for name in sources:
+        api = write_source(name, crashes, seed)
+        for node in api.pipeline_nodes():
+            if not node.name.endswith('/download'):
+                node.function(*node.args)
+        indexes[name] = load_index(api, SOURCES[name].row_data_getter(column_names=api.column_names), cell_size)
+    return indexes
+
+
+# `count` distinct query URLs: bboxes up to `max_degrees` wide around random crashes, some limited to a few years or
+# to a harm.
+def random_queries(indexes, count, max_degrees, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(count):
+        name = list(indexes)[rng.integers(len(indexes))]
+        index = indexes[name]
+        position = rng.integers(index.meta['rows'])
+        longitude, latitude = float(index.columns['longitude'][position]), float(index.columns['latitude'][position])
+        width, height = rng.random(2) * max_degrees
+        query = f'/crashes?source={name}&bbox={longitude - width / 2:.4f},{latitude - height / 2:.4f},' \
+                f'{longitude + width / 2:.4f},{latitude + height / 2:.4f}'
+        if rng.random() < 0.5:
+            first, last = index.meta['years']
+            start = int(rng.integers(first, last + 1))
+            query += f'&years={start}-{min(last, start + 2)}'
+        if rng.random() < 0.3:
+            query += f'&harm={HARM_CATEGORIES[rng.integers(len(HARM_CATEGORIES))]}'
+        if rng.random() < 0.5:
+            query += '&format=binary'
+        queries.append(query)
+    return queries
+
+
+async def request(reader, writer, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status, length
+
+
+# One keep-alive connection sending its share of the requests one after another.
+async def client(port, paths, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        for path in paths:
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, path)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def load_test(service, queries, requests, connections, seed=0):
+    server = await service.start(port=0)
+    port = server.sockets[0].getsockname()[1]
+    rng = np.random.default_rng(seed)
+    paths = [queries[i] for i in rng.integers(len(queries), size=requests)]
+    latencies, statuses = [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, paths[i::connections], latencies, statuses) for i in range(connections)))
+    seconds = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return seconds, np.array(latencies), statuses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-tests the query service on synthetic data, with the clients '
+                                                 'and the service in one process on this machine.')
+    parser.add_argument('--sources', nargs='*', default=list(SOURCES), choices=list(SOURCES))
+    parser.add_argument('--crashes', type=int, default=100000)
+    parser.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE)
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--distinct', type=int, default=500, help='Distinct queries; fewer means more cache hits')
+    parser.add_argument('--max-degrees', type=float, default=1)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            query_service = QueryService(build_indexes(args.sources, args.crashes, args.cell_size),
+                                         cache_bytes=args.cache_bytes)
+            run = load_test(query_service, random_queries(query_service.indexes, args.distinct, args.max_degrees),
+                            args.requests, args.connections)
+            total_seconds, request_seconds, status_counts = asyncio.run(run)
+        finally:
+            os.chdir(cwd)
+
+    print(f'{args.requests} requests over {args.connections} connections in {total_seconds:.2f}s: '
+          f'{args.requests / total_seconds:.0f} requests/s')
+    print('latency ' + ', '.join(f'p{p}: {np.percentile(request_seconds, p) * 1000:.1f} ms' for p in [50, 95, 99]))
+    print(f'statuses {status_counts}, cache {query_service.cache.stats()}')
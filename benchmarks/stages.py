@@ -0,0 +1,160 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+from benchmarks.synthetic import SOURCES, write_source
+from instrumentation import RunReport
+from storage import get_storage
+from web_data import WEB_BASE_DIR, WebDataGenerator
+
+# The committed baselines only hold what a run must produce: row counts and a digest of the tiles. Timings depend on the
+# machine, so timing baselines stay in an untracked directory and are compared only on the machine that recorded them.
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+TIMINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timings.nosync')
+OUTPUT_KEYS = ['source', 'crashes', 'storage', 'rows', 'sizes', 'tiles_digest']
+# A stage regressed if it got this much slower than its baseline, and by more than MIN_SLOWDOWN seconds.
+TOLERANCE = 0.25
+MIN_SLOWDOWN = 0.05
+
+
+# Hash of every file under `directory`, so runs can be checked to write exactly the same tiles.
+def directory_digest(directory):
+    digest = hashlib.sha256()
+    for path in sorted(os.path.join(p, f) for p, _, fs in os.walk(directory) for f in fs):
+        digest.update(os.path.relpath(path, directory).encode())
+        with open(path, 'rb') as infile:
+            digest.update(infile.read())
+    return digest.hexdigest()
+
+
+# Bytes of the crash tiles and of each pyramid level's cluster tiles, as listed in the metadata, uncompressed.
+def output_sizes(generator: WebDataGenerator):
+    with open(f'{generator.web_data_dir}/file-metadata.json') as infile:
+        metadata = json.load(infile)
+    return {
+        'tiles': sum(os.path.getsize(f'{WEB_BASE_DIR}/{f}') for f in metadata['filenames']),
+        'levels': {level['directory']: sum(os.path.getsize(f'{WEB_BASE_DIR}/{f}') for f in level['filenames'])
+                   for level in metadata.get('levels', [])},
+    }
+
+
+def generator_for(name, report=None, **options):
+    source = SOURCES[name]
+    return WebDataGenerator(row_data_getter=source.row_data_getter(column_names=source.column_names),
+                            column_names=source.column_names, data_description=source.data_description,
+                            report=report, **{**(source.generator_options or {}), **options})
+
+
+# Runs every stage of one source on synthetic data in a scratch directory, returning the stage timings and a digest of
+# the tiles written.
+def run_source(name, crashes, storage=None, workers=1, seed=0):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api = write_source(name, crashes, seed, get_storage(storage))
+            report = RunReport()
+            api.report = report
+            for node in api.pipeline_nodes():
+                if not node.name.endswith('/download'):
+                    with report.stage(node.name):
+                        node.function(*node.args)
+            with report.stage(f'{name}/read'):
+                df = api.read_data()
+            generator = generator_for(name, report=report)
+            with report.stage(f'web/{name}'):
+                generator.iterate_and_save(df, latlong_interval=SOURCES[name].latlong_interval, workers=workers)
+            digest = directory_digest(f'{WEB_BASE_DIR}/{generator.data_dir}')
+            sizes = output_sizes(generator)
+        finally:
+            os.chdir(cwd)
+    return {
+        'source': name,
+        'crashes': crashes,
+        'storage': type(api.storage).__name__,
+        'workers': workers,
+        'stages': {s.name: round(s.wall_seconds, 4) for s in report.stages},
+        'rows': {s.name: [s.rows_in, s.rows_out] for s in report.stages},
+        'slowest_tiles': [{'name': t.name, 'rows': t.rows, 'seconds': round(t.seconds, 4)}
+                          for t in report.slowest_tiles(5)],
+        'sizes': sizes,
+        'tiles_digest': digest,
+    }
+
+
+def baseline_file(result, directory=BASELINE_DIR):
+    return os.path.join(directory, f'{result["source"]}-{result["crashes"]}-{result["storage"]}.json')
+
+
+def read_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def write_baseline(path, baseline):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as outfile:
+        json.dump(baseline, outfile, indent=2)
+    print(f'Saved {path}')
+
+
+# Stages whose row counts changed, pyramid levels that are no smaller than the crash tiles they summarize, and whether
+# the tiles changed, compared with the committed baseline, and stages that got slower than in the local timing
+# baseline, if there is one.
+def regressions(result, expected, timings=None):
+    found = [f'{stage}: rows {expected["rows"][stage]} -> {rows}' for stage, rows in result['rows'].items()
+             if stage in expected['rows'] and expected['rows'][stage] != rows]
+    found += [f'{level}: {size} bytes, no smaller than the {result["sizes"]["tiles"]} bytes of crash tiles'
+              for level, size in result['sizes']['levels'].items() if size >= result['sizes']['tiles']]
+    if result['tiles_digest'] != expected['tiles_digest']:
+        found.append('tiles differ from the baseline run')
+    for stage, seconds in result['stages'].items():
+        before = (timings or {}).get('stages', {}).get(stage)
+        if before is not None and seconds > before * (1 + TOLERANCE) and seconds - before > MIN_SLOWDOWN:
+            found.append(f'{stage}: {before:.3f}s -> {seconds:.3f}s')
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times every pipeline stage and tile generation on synthetic data, '
+                                                 'comparing with the stored baselines.')
+    parser.add_argument('--sources', nargs='*', default=list(SOURCES), choices=list(SOURCES))
+    parser.add_argument('--crashes', type=int, default=10000)
+    parser.add_argument('--storage', choices=['pickle', 'parquet', 'feather'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--save-baseline', action='store_true', help='Store the outputs in the committed baselines '
+                                                                      'and the timings locally')
+    parser.add_argument('--save-timings', action='store_true', help='Store just the local timing baselines')
+    args = parser.parse_args()
+
+    failed = False
+    for source_name in args.sources:
+        result = run_source(source_name, args.crashes, args.storage, args.workers)
+        for stage_name, stage_seconds in result['stages'].items():
+            print(f'{stage_name:>32}: {stage_seconds * 1000:9.1f} ms')
+        for directory, size in {'crash tiles': result['sizes']['tiles'], **result['sizes']['levels']}.items():
+            print(f'{directory:>32}: {size / 1024:9.1f} KiB')
+        path, timings_path = baseline_file(result), baseline_file(result, TIMINGS_DIR)
+        if args.save_baseline or args.save_timings:
+            if args.save_baseline:
+                write_baseline(path, {key: result[key] for key in OUTPUT_KEYS})
+            write_baseline(timings_path, result)
+            continue
+        expected = read_baseline(path)
+        if expected is None:
+            print(f'No baseline at {path}; run with --save-baseline to store one.')
+            continue
+        timings = read_baseline(timings_path)
+        if timings is None:
+            print(f'No timings at {timings_path}; only outputs are compared. Run with --save-timings on this '
+                  f'machine to compare timings.')
+        problems = regressions(result, expected, timings)
+        for problem in problems:
+            print(f'REGRESSION {source_name}: {problem}')
+        failed |= bool(problems)
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,243 @@
+import argparse
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from dc import DC_DATA_DESCRIPTION, DcApiDataInterface, DcRowDataGetter, INJURY_FATALITY_COLUMNS
+from dc import COLUMN_NAMES as DC_COLUMN_NAMES
+from fars import FARS_DATA_DESCRIPTION, FARS_PYRAMID, FarsApiDataInterface, FarsRowDataGetter, INJURY_TYPE, PER_TYPE
+from fars import COLUMN_NAMES as FARS_COLUMN_NAMES
+from maryland import MARYLAND_DATA_DESCRIPTION, MarylandApiDataInterface, MarylandRowDataGetter
+from maryland import COLUMN_NAMES as MARYLAND_COLUMN_NAMES
+from web_data import DETAIL_SHARD_SIZE
+
+# Crashes are written in chunks of this many, so 10M-crash sources don't have to fit in memory at once.
+CHUNK_SIZE = 1 << 20
+
+
+@dataclass
+class Metro:
+    latitude: float
+    longitude: float
+    weight: float
+    # Standard deviation of the crashes' distance from the center, in degrees.
+    spread: float
+
+
+@dataclass
+class Region:
+    # (min_longitude, min_latitude, max_longitude, max_latitude) of crashes outside metros.
+    bbox: tuple
+    metros: list
+    rural_share: float
+
+
+US = Region(bbox=(-124, 25, -67, 49), rural_share=0.4, metros=[
+    Metro(40.71, -74.00, 5, 0.3), Metro(34.05, -118.24, 6, 0.5), Metro(41.88, -87.63, 3, 0.3),
+    Metro(29.76, -95.37, 4, 0.4), Metro(33.45, -112.07, 3, 0.3), Metro(33.75, -84.39, 3, 0.4),
+    Metro(25.76, -80.19, 3, 0.3), Metro(32.78, -96.80, 3, 0.4), Metro(38.91, -77.04, 2, 0.2),
+    Metro(47.61, -122.33, 1, 0.2), Metro(39.74, -104.99, 1, 0.2), Metro(35.23, -80.84, 1, 0.3),
+])
+DC = Region(bbox=(-77.12, 38.80, -76.91, 38.99), rural_share=0.2, metros=[
+    Metro(38.90, -77.03, 3, 0.015), Metro(38.87, -76.99, 1, 0.015), Metro(38.94, -77.02, 1, 0.02),
+])
+MARYLAND = Region(bbox=(-79.5, 37.9, -75.1, 39.7), rural_share=0.3, metros=[
+    Metro(39.29, -76.61, 4, 0.08), Metro(38.98, -76.94, 3, 0.1), Metro(39.08, -77.15, 2, 0.08),
+    Metro(39.41, -77.41, 1, 0.05), Metro(38.98, -76.49, 1, 0.05),
+])
+
+
+def clustered_points(rng, count, region: Region):
+    metros = region.metros
+    weights = np.array([m.weight for m in metros], dtype=float)
+    chosen = rng.choice(len(metros), size=count, p=weights / weights.sum())
+    spread = np.array([m.spread for m in metros])[chosen]
+    latitudes = np.array([m.latitude for m in metros])[chosen] + rng.normal(0, 1, count) * spread
+    longitudes = np.array([m.longitude for m in metros])[chosen] + rng.normal(0, 1, count) * spread
+    rural = rng.random(count) < region.rural_share
+    min_longitude, min_latitude, max_longitude, max_latitude = region.bbox
+    latitudes[rural] = rng.uniform(min_latitude, max_latitude, rural.sum())
+    longitudes[rural] = rng.uniform(min_longitude, max_longitude, rural.sum())
+    return latitudes.round(6), longitudes.round(6)
+
+
+# Number of children (people, vehicles, ...) of each crash, with at least `minimum` per crash.
+def child_counts(rng, count, mean, minimum=1):
+    return minimum + rng.poisson(mean - minimum, count)
+
+
+def write_chunk(df, path, first):
+    df.to_csv(path, index=False, mode='w' if first else 'a', header=first)
+
+
+def random_dates(rng, count, first_year, last_year):
+    days = rng.integers(0, (pd.Timestamp(f'{last_year + 1}-01-01') - pd.Timestamp(f'{first_year}-01-01')).days, count)
+    return pd.Timestamp(f'{first_year}-01-01') + pd.to_timedelta(days, unit='D')
+
+
+def chunks(crashes):
+    for start in range(0, crashes, CHUNK_SIZE):
+        yield start, min(CHUNK_SIZE, crashes - start)
+
+
+def write_fars(api: FarsApiDataInterface, crashes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    years = list(api.years)
+    per_type_codes = list(PER_TYPE) + [99]
+    per_type_weights = np.array([50, 20, 1, 1, 16, 3, 1, 1, 1, 1, 1, 4], dtype=float)
+    for year in years:
+        for start, count in chunks(crashes // len(years)):
+            first = start == 0
+            latitudes, longitudes = clustered_points(rng, count, US)
+            states = rng.integers(1, 57, count)
+            st_case = states * 100000 + start + np.arange(count)
+            keys = {'STATE': states, 'ST_CASE': st_case, 'CASEYEAR': year}
+
+            people = child_counts(rng, count, 2.2)
+            parent = np.repeat(np.arange(count), people)
+            first_person = np.concatenate([[0], np.cumsum(people)[:-1]])
+            injuries = rng.choice(list(INJURY_TYPE) + [9], size=len(parent), p=[.4, .1, .1, .1, .2, .05, .01, .04])
+            # Every FARS crash has a fatality.
+            injuries[first_person] = 4
+            per_types = rng.choice(per_type_codes, size=len(parent), p=per_type_weights / per_type_weights.sum())
+            ages = np.where(rng.random(len(parent)) < 0.05, rng.choice([998, 999], len(parent)),
+                            rng.integers(0, 97, len(parent)))
+            write_chunk(pd.DataFrame({
+                **{k: v[parent] if isinstance(v, np.ndarray) else v for k, v in keys.items()},
+                'PER_NO': np.arange(len(parent)) - first_person[parent] + 1,
+                'PER_TYP': per_types, 'PER_TYPNAME': pd.Series(per_types).map({k: v.name for k, v in PER_TYPE.items()}),
+                'INJ_SEV': injuries,
+                'INJ_SEVNAME': pd.Series(injuries).map({k: v.name for k, v in INJURY_TYPE.items()}),
+                'AGE': ages,
+            }), api.downloaded_data_file('Person', year), first)
+
+            fatalities = np.bincount(parent[injuries == 4], minlength=count)
+            write_chunk(pd.DataFrame({**keys, 'STATENAME': states.astype(str), 'LATITUDE': latitudes,
+                                      'LONGITUD': longitudes, 'FATALS': fatalities,
+                                      'HOUR': rng.integers(0, 24, count)}),
+                        api.downloaded_data_file('Accident', year), first)
+
+            vehicles = child_counts(rng, count, 1.6)
+            parent = np.repeat(np.arange(count), vehicles)
+            write_chunk(pd.DataFrame({**{k: v[parent] if isinstance(v, np.ndarray) else v for k, v in keys.items()},
+                                      'VEH_NO': np.arange(len(parent)) - np.repeat(np.cumsum(vehicles) - vehicles,
+                                                                                   vehicles) + 1}),
+                        api.downloaded_data_file('Vehicle', year), first)
+
+
+def write_dc(api: DcApiDataInterface, crashes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    for start, count in chunks(crashes):
+        first = start == 0
+        latitudes, longitudes = clustered_points(rng, count, DC)
+        # Some crashes have no location, or no injuries and are dropped by filter_rows.
+        latitudes[rng.random(count) < 0.02] = np.nan
+        crime_ids = start + np.arange(count) + 20000000
+        from_dates = random_dates(rng, count, 2009, 2022).strftime('%Y/%m/%d %H:%M:%S+00').to_numpy(dtype=object)
+        report_dates = random_dates(rng, count, 2009, 2022).strftime('%Y/%m/%d %H:%M:%S+00')
+        from_dates[rng.random(count) < 0.03] = '1900/01/01 00:00:00+00'
+        from_dates[rng.random(count) < 0.03] = None
+        injuries = {c: (rng.random(count) < (0.02 if c.startswith('FATAL') else 0.08)).astype(int)
+                    for c in INJURY_FATALITY_COLUMNS}
+        write_chunk(pd.DataFrame({'CRIMEID': crime_ids, 'LATITUDE': latitudes, 'LONGITUDE': longitudes,
+                                  'TOTAL_VEHICLES': rng.integers(1, 4, count), **injuries, 'FROMDATE': from_dates,
+                                  'REPORTDATE': report_dates, 'ADDRESS': 'X'}),
+                    api.downloaded_data_file('Crash'), first)
+
+        people = child_counts(rng, count, 2, minimum=0)
+        parent = np.repeat(np.arange(count), people)
+        size = len(parent)
+        ages = rng.integers(1, 90, size).astype(float)
+        ages[rng.random(size) < 0.2] = np.nan
+        write_chunk(pd.DataFrame({
+            'CRIMEID': crime_ids[parent],
+            'PERSONTYPE': rng.choice(['Driver', 'Passenger', 'Pedestrian', 'Bicyclist', 'Unknown', 'Streetcar'],
+                                     size=size, p=[.55, .25, .1, .05, .04, .01]),
+            'AGE': ages,
+            'FATAL': np.where(rng.random(size) < 0.01, 'Y', 'N'),
+            'MAJORINJURY': np.where(rng.random(size) < 0.05, 'Y', 'N'),
+            'MINORINJURY': np.where(rng.random(size) < 0.2, 'Y', 'N'),
+        }), api.downloaded_data_file('Detail'), first)
+
+
+def write_maryland(api: MarylandApiDataInterface, crashes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    paths = {table.name: path for table, path in api.tables_to_files()}
+    for start, count in chunks(crashes):
+        first = start == 0
+        latitudes, longitudes = clustered_points(rng, count, MARYLAND)
+        report_numbers = pd.Series(start + np.arange(count)).map('MSP{:08d}'.format).to_numpy()
+        dates = random_dates(rng, count, 2015, 2021)
+        write_chunk(pd.DataFrame({
+            'REPORT_NO': report_numbers,
+            'REPORT_TYPE': rng.choice(['Property Damage Crash', 'Injury Crash', 'Fatal Crash'], size=count,
+                                      p=[.65, .34, .01]),
+            'HARM_EVENT_DESC1': rng.choice(['Other Vehicle', 'Fixed Object', 'Pedestrian', 'Bicycle'], size=count,
+                                           p=[.7, .2, .07, .03]),
+            'HARM_EVENT_DESC2': rng.choice(['Other Vehicle', 'Not Applicable'], size=count),
+            'LATITUDE': latitudes, 'LONGITUDE': longitudes,
+            'YEAR': dates.year, 'ACC_DATE': dates.strftime('%Y%m%d'),
+        }), paths['Crash'], first)
+
+        people = child_counts(rng, count, 2.3)
+        parent = np.repeat(np.arange(count), people)
+        size = len(parent)
+        births = random_dates(rng, size, 1930, 2010).strftime('%Y%m%d').to_numpy(dtype=object)
+        births[rng.random(size) < 0.1] = None
+        write_chunk(pd.DataFrame({
+            'REPORT_NO': report_numbers[parent],
+            'PERSON_TYPE': rng.choice(list('DOP'), size=size, p=[.6, .35, .05]),
+            'INJ_SEVER_CODE': rng.choice([1, 2, 3, 4, 5], size=size, p=[.7, .15, .1, .04, .01]),
+            'DATE_OF_BIRTH': births,
+        }), paths['Person'], first)
+
+        vehicles = child_counts(rng, count, 1.8)
+        write_chunk(pd.DataFrame({'REPORT_NO': report_numbers[np.repeat(np.arange(count), vehicles)],
+                                  'VEHICLE_ID': np.arange(vehicles.sum())}), paths['Vehicle'], first)
+
+
+@dataclass
+class Source:
+    interface: type
+    write: object
+    row_data_getter: type
+    column_names: object
+    data_description: object
+    latlong_interval: int
+    generator_options: dict = None
+
+
+def fars_interface():
+    return FarsApiDataInterface(years=range(2019, 2021))
+
+
+SOURCES = {
+    'fars': Source(fars_interface, write_fars, FarsRowDataGetter, FARS_COLUMN_NAMES, FARS_DATA_DESCRIPTION, 2,
+                   {'binary_tiles': True, 'pyramid': FARS_PYRAMID, 'detail_shard_size': DETAIL_SHARD_SIZE}),
+    'dc': Source(DcApiDataInterface, write_dc, DcRowDataGetter, DC_COLUMN_NAMES, DC_DATA_DESCRIPTION, 1),
+    'maryland': Source(MarylandApiDataInterface, write_maryland, MarylandRowDataGetter, MARYLAND_COLUMN_NAMES,
+                       MARYLAND_DATA_DESCRIPTION, 2),
+}
+
+
+def write_source(name, crashes, seed=0, storage=None):
+    source = SOURCES[name]
+    api = source.interface()
+    if storage is not None:
+        api.storage = storage
+    os.makedirs(api.data_dir(), exist_ok=True)
+    source.write(api, crashes, seed)
+    return api
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic source CSVs under data.nosync in the working '
+                                                 'directory.')
+    parser.add_argument('--sources', nargs='*', default=list(SOURCES), choices=list(SOURCES))
+    parser.add_argument('--crashes', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for source_name in args.sources:
+        write_source(source_name, args.crashes, args.seed)
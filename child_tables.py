@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+CHILD_TABLES_ATTR = 'child_tables'
+
+
+# Child tables travel with their parent frame in DataFrame.attrs. They are never modified in place, so copies of the
+# parent share them rather than deep-copying (or comparing) whole tables.
+class ChildTables(dict):
+    def __deepcopy__(self, memo):
+        return self
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = None
+
+
+def offset_column(name):
+    return f'{name}_offset'
+
+
+def length_column(name):
+    return f'{name}_length'
+
+
+def child_tables(df: pd.DataFrame) -> dict:
+    return df.attrs.get(CHILD_TABLES_ATTR, {})
+
+
+def with_child_tables(df: pd.DataFrame, tables: dict) -> pd.DataFrame:
+    if tables:
+        df.attrs[CHILD_TABLES_ATTR] = ChildTables(tables)
+    return df
+
+
+def parent_positions(parent: pd.DataFrame, child: pd.DataFrame, key_columns: list):
+    if len(key_columns) == 1:
+        return parent.index.get_indexer(child[key_columns[0]])
+    return parent.index.get_indexer(pd.MultiIndex.from_frame(child[key_columns]))
+
+
+# Sorts the child rows by the position of their parent (a row of `parent`, indexed by `key_columns`) and gives the
+# parent `{name}_offset` and `{name}_length` columns locating its children. Children without a parent are dropped.
+def link_child_table(parent: pd.DataFrame, child: pd.DataFrame, key_columns: list, name: str):
+    positions = parent_positions(parent, child, key_columns)
+    linked = positions >= 0
+    order = np.argsort(positions[linked], kind='stable')
+    child = child.drop(columns=key_columns)[linked].iloc[order].reset_index(drop=True)
+    lengths = np.bincount(positions[linked], minlength=len(parent))
+    parent = parent.assign(**{offset_column(name): np.cumsum(lengths) - lengths, length_column(name): lengths})
+    return parent, child
+
+
+# Expands (offset, length) pairs into the child rows they cover and the parent position each child row belongs to.
+def child_row_positions(offsets: np.ndarray, lengths: np.ndarray):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    parents = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.repeat(offsets - (np.cumsum(lengths) - lengths), lengths)
+    return parents, starts + np.arange(len(parents))
+
+
+def child_records(df: pd.DataFrame, name: str, columns: list = None) -> pd.DataFrame:
+    parents, rows = child_row_positions(df[offset_column(name)].to_numpy(), df[length_column(name)].to_numpy())
+    records = child_tables(df)[name].iloc[rows]
+    if columns is not None:
+        records = records.reindex(columns=columns)
+    return records.set_axis(parents).astype(object)
+
+
+def child_lengths(df: pd.DataFrame, name: str) -> list:
+    return df[length_column(name)].astype(int).tolist()
+
+
+# Slices parent rows by position, keeping only the children those rows reference.
+def take_rows(df: pd.DataFrame, positions) -> pd.DataFrame:
+    taken = df.iloc[positions]
+    tables = {}
+    for name, child in child_tables(df).items():
+        lengths = taken[length_column(name)].to_numpy()
+        _, rows = child_row_positions(taken[offset_column(name)].to_numpy(), lengths)
+        tables[name] = child.iloc[rows].reset_index(drop=True)
+        taken = taken.assign(**{offset_column(name): np.cumsum(lengths) - lengths})
+    return with_child_tables(taken, tables)
+
+
+def concat_with_child_tables(dfs: list) -> pd.DataFrame:
+    names = list(child_tables(dfs[0]))
+    df = pd.concat(dfs, axis=0)
+    lengths = [len(d) for d in dfs]
+    # Each part's offsets point into its own child tables; shift them past the children of the parts before it.
+    for name in names:
+        sizes = [len(child_tables(d)[name]) for d in dfs]
+        shifts = np.repeat(np.cumsum(sizes) - sizes, lengths)
+        df[offset_column(name)] = df[offset_column(name)].to_numpy() + shifts
+    return with_child_tables(df, {name: pd.concat([child_tables(d)[name] for d in dfs], ignore_index=True)
+                                  for name in names})
+
+
+# Turns each child table back into per-row lists of dicts (NaN where a row has none), as a record join stores them.
+def with_record_columns(df: pd.DataFrame) -> pd.DataFrame:
+    tables = child_tables(df)
+    if not tables:
+        return df
+    columns = {}
+    for name, child in tables.items():
+        records = child.to_dict('records') if len(child.columns) else [{}] * len(child)
+        columns[name] = [records[o:o + n] if n else math.nan
+                         for o, n in zip(df[offset_column(name)].tolist(), df[length_column(name)].tolist())]
+    df = df.drop(columns=[c for name in tables for c in (offset_column(name), length_column(name))])
+    df.attrs = {k: v for k, v in df.attrs.items() if k != CHILD_TABLES_ATTR}
+    return df.assign(**columns)
@@ -2,6 +2,14 @@ from dataclasses import dataclass
 from enum import Enum
 
 
+@dataclass
+class ColumnNames:
+    latitude: str = 'LATITUDE'
+    longitude: str = 'LONGITUDE'
+    year: str = 'YEAR'
+    id: str = None
+
+
 class CrashCategory(Enum):
     MOTOR_VEHICLE = 'car'
     BICYCLE = 'bike'
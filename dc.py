@@ -4,8 +4,11 @@ from collections import defaultdict
 import pandas as pd
 
 from api_data import ApiDataInterface, Table, Tables
-from constants import PersonType, InjuryType, CrashCategory
-from web_data import RowDataGetter, WebDataGenerator, DataDescription, Links, ColumnNames
+from constants import ColumnNames, PersonType, InjuryType, CrashCategory
+from derived import DatePart, Fallback, SumOf
+from schema import DATETIME
+from web_data import RowDataGetter, WebDataGenerator, DataDescription, Links, child_rows, \
+    group_by_position, most_severe_category
 
 INJURY_PREFIXES = ['MAJORINJURIES', 'MINORINJURIES', 'UNKNOWNINJURIES', 'FATAL']
 PERSON_TYPE_SUFFIXES = ['_BICYCLIST', '_DRIVER', '_PEDESTRIAN', 'PASSENGER']
@@ -16,9 +19,17 @@ FATALITY_COLUMNS = ['FATAL' + p for p in PERSON_TYPE_SUFFIXES]
 DC_TABLES = Tables(
     key_columns=['CRIMEID'],
     crash=Table(name='Crash', columns=['LATITUDE', 'LONGITUDE', 'YEAR', 'TOTAL_VEHICLES'] + INJURY_FATALITY_COLUMNS,
+                # The report date stands in for crashes without a usable date of the crash itself.
+                derived={'FROMYEAR': DatePart('FROMDATE'), 'REPORTYEAR': DatePart('REPORTDATE'),
+                         'YEAR': Fallback('FROMYEAR', 'REPORTYEAR', invalid=[1900]),
+                         'CASUALTIES': SumOf(INJURY_FATALITY_COLUMNS)},
+                dtypes={'LATITUDE': 'float32', 'LONGITUDE': 'float32', 'TOTAL_VEHICLES': 'int8',
+                        'FROMDATE': DATETIME, 'REPORTDATE': DATETIME, **{c: 'int8' for c in INJURY_FATALITY_COLUMNS}},
                 url='https://opendata.arcgis.com/api/v3/datasets/70392a096a8e431381f1f692aaa06afd_24/downloads/data'
                     '?format=csv&spatialRefId=4326'),
     detail=Table(name='Detail', columns=['PERSONTYPE', 'AGE', 'FATAL', 'MAJORINJURY', 'MINORINJURY'],
+                 dtypes={'PERSONTYPE': 'category', 'AGE': 'float32', 'FATAL': 'category', 'MAJORINJURY': 'category',
+                         'MINORINJURY': 'category'},
                  url='https://opendata.arcgis.com/api/v3/datasets/70248b73c20f46b0a5ee895fc91d6222_25/downloads/data'
                      '?format=csv&spatialRefId=4326'),
 )
@@ -72,34 +83,12 @@ def get_age(p):
 
 class DcApiDataInterface(ApiDataInterface):
     def __init__(self):
-        super(DcApiDataInterface, self).__init__(entity='dc', tables=DC_TABLES)
-
-    def convert_data_types(self, df, dataset: Table = None) -> None:
-        if dataset.name == 'Crash':
-            for col in INJURY_FATALITY_COLUMNS:
-                df[col] = pd.to_numeric(df[col], errors='ignore')
-            df['FROMDATE'] = pd.to_datetime(df['FROMDATE'], errors='ignore')
-            df['REPORTDATE'] = pd.to_datetime(df['REPORTDATE'], errors='ignore')
-
-    def add_columns(self, df, dataset: Table) -> None:
-        if dataset.name == 'Crash':
-            df['FROMYEAR'] = pd.DatetimeIndex(df['FROMDATE']).year
-            df['REPORTYEAR'] = pd.DatetimeIndex(df['REPORTDATE']).year
-
-            def get_year(row):
-                from_year = row['FROMYEAR']
-                return row['REPORTYEAR'] if math.isnan(from_year) or from_year == 1900 else from_year
-
-            df['YEAR'] = df.apply(lambda row: get_year(row), axis=1)
-        return df
+        super(DcApiDataInterface, self).__init__(entity='dc', tables=DC_TABLES, column_names=COLUMN_NAMES)
 
     def filter_rows(self, df, dataset: Table = None):
-        filtered = df
         if dataset.name == 'Crash':
-            filtered = filtered[filtered[INJURY_FATALITY_COLUMNS].sum(axis=1) > 0]
-            filtered = filtered[filtered['LATITUDE'].notnull()]
-            filtered = filtered[filtered['YEAR'].notnull()]
-        return filtered
+            return df[(df['CASUALTIES'] > 0) & df['LATITUDE'].notnull() & df['YEAR'].notnull()]
+        return df
 
 
 class DcRowDataGetter(RowDataGetter):
@@ -132,6 +121,33 @@ class DcRowDataGetter(RowDataGetter):
             injuries[injury_type(p).value.category.value].append(info)
         return injuries
 
+    @staticmethod
+    def details(df):
+        details = child_rows(df, 'Detail', DC_TABLES.detail.columns)
+        person_types = details[PERSON_TYPE_COLUMN].str.strip().map(PERSON_TYPE_TO_PERSON)
+        fatal = details['FATAL'] == 'Y'
+        injured = (details['MAJORINJURY'] == 'Y') | (details['MINORINJURY'] == 'Y')
+        injury_types = pd.Series([InjuryType.FATALITY if f else InjuryType.INJURY if i else InjuryType.NO_INJURY
+                                  for f, i in zip(fatal, injured)], index=details.index, dtype=object)
+        return details, person_types, injury_types
+
+    def category_column(self, df):
+        details, person_types, injury_types = self.details(df)
+        return most_severe_category(injury_types, person_types, len(df), CrashCategory.OTHER.value)
+
+    def num_fatalities_column(self, df):
+        return df[FATALITY_COLUMNS].sum(axis=1).tolist()
+
+    def num_vehicles_column(self, df):
+        return df['TOTAL_VEHICLES'].tolist()
+
+    def injuries_column(self, df):
+        details, person_types, injury_types = self.details(df)
+        ages = pd.to_numeric(details['AGE'], errors='coerce')
+        infos = [{'person': p.value.description, 'age': 'unknown' if math.isnan(a) else int(a)}
+                 for p, a in zip(person_types, ages)]
+        return group_by_position(details.index, [i.value.category.value for i in injury_types], infos, len(df))
+
 
 if __name__ == '__main__':
     api = DcApiDataInterface()
@@ -145,4 +161,4 @@ if __name__ == '__main__':
                                           column_names=COLUMN_NAMES,
                                           data_description=DC_DATA_DESCRIPTION)
 
-    web_data_generator.iterate_and_save(df, latlong_interval=1)
+    web_data_generator.iterate_and_save(df, latlong_interval=1, incremental=True)
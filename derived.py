@@ -0,0 +1,88 @@
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+
+# Each expression names the columns it reads and computes a whole column at once.
+@dataclass
+class DatePart:
+    column: str
+    part: str = 'year'
+
+    def inputs(self):
+        return [self.column]
+
+    def evaluate(self, df):
+        return getattr(pd.to_datetime(df[self.column]).dt, self.part)
+
+
+@dataclass
+class Coalesce:
+    columns: list
+
+    def inputs(self):
+        return self.columns
+
+    def evaluate(self, df):
+        values = df[self.columns[0]]
+        for column in self.columns[1:]:
+            values = values.fillna(df[column])
+        return values
+
+
+# `column` where it is set and not one of `invalid`, `fallback` elsewhere.
+@dataclass
+class Fallback:
+    column: str
+    fallback: str
+    invalid: list = field(default_factory=list)
+
+    def inputs(self):
+        return [self.column, self.fallback]
+
+    def evaluate(self, df):
+        values = df[self.column]
+        return values.where(values.notnull() & ~values.isin(self.invalid), df[self.fallback])
+
+
+@dataclass
+class SumOf:
+    columns: list
+
+    def inputs(self):
+        return self.columns
+
+    def evaluate(self, df):
+        return df[self.columns].sum(axis=1)
+
+
+def derivation_order(derived: dict) -> list:
+    order = []
+    visiting = set()
+
+    def visit(column):
+        if column in order:
+            return
+        if column in visiting:
+            raise ValueError(f'Derived column {column} depends on itself')
+        visiting.add(column)
+        for dependency in derived[column].inputs():
+            if dependency in derived:
+                visit(dependency)
+        visiting.remove(column)
+        order.append(column)
+
+    for column in derived:
+        visit(column)
+    return order
+
+
+# Source columns the expressions read, leaving out the ones derived from others.
+def derived_inputs(derived: dict) -> list:
+    return list(dict.fromkeys(c for expression in derived.values() for c in expression.inputs() if c not in derived))
+
+
+def derive_columns(df: pd.DataFrame, derived: dict) -> pd.DataFrame:
+    for column in derivation_order(derived):
+        df[column] = derived[column].evaluate(df)
+    return df
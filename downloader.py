@@ -0,0 +1,103 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BOM = b'\xef\xbb\xbf'
+
+
+@dataclass
+class Download:
+    url: str
+    path: str
+    params: dict = None
+
+
+class Downloader:
+    def __init__(self, max_workers: int = 4, chunk_size: int = 1 << 20, timeout: float = 60, strip_bom: bool = True):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.strip_bom = strip_bom
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def partial_path(path):
+        return f'{path}.part'
+
+    # Sidecar holding the response's ETag/Last-Modified, plus how many leading bytes (a BOM) were dropped,
+    # so a resumed Range request starts at the right offset of the remote body.
+    @staticmethod
+    def state_path(path):
+        return f'{path}.download.json'
+
+    def read_state(self, path):
+        try:
+            with open(self.state_path(path)) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return {}
+
+    def write_state(self, path, response, skipped):
+        state = {k: response.headers[h] for k, h in [('etag', 'ETag'), ('last_modified', 'Last-Modified')]
+                 if h in response.headers}
+        state['skipped'] = skipped
+        with open(self.state_path(path), 'w') as outfile:
+            json.dump(state, outfile)
+
+    def download(self, download: Download, refresh: bool = False):
+        path = download.path
+        if os.path.exists(path) and not refresh:
+            return False
+
+        headers = {}
+        state = self.read_state(path)
+        partial = self.partial_path(path)
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset:
+            # Resume the interrupted download; If-Range makes the server send the whole body if it changed since.
+            headers['Range'] = f'bytes={offset + state.get("skipped", 0)}-'
+            if state.get('etag') or state.get('last_modified'):
+                headers['If-Range'] = state.get('etag') or state['last_modified']
+        elif os.path.exists(path):
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+
+        with self.session.get(download.url, params=download.params, headers=headers, stream=True,
+                              timeout=self.timeout) as response:
+            if response.status_code == 304:
+                return False
+            if response.status_code == 416:
+                # The partial file is unusable (e.g. the resource shrank); start over next time.
+                os.remove(partial)
+                response.raise_for_status()
+            response.raise_for_status()
+            skipped = state.get('skipped', 0) if response.status_code == 206 else 0
+            if response.status_code != 206:
+                offset = 0
+
+            with open(partial, 'ab' if offset else 'wb') as outfile:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if not offset and self.strip_bom and chunk.startswith(BOM):
+                        chunk = chunk[len(BOM):]
+                        skipped = len(BOM)
+                    if not offset:
+                        # Written before any body bytes, so an interruption still leaves a consistent state.
+                        self.write_state(path, response, skipped)
+                    offset += len(chunk)
+                    outfile.write(chunk)
+            self.write_state(path, response, skipped)
+        os.replace(partial, path)
+        return True
+
+    def download_all(self, downloads: list, refresh: bool = False):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda d: self.download(d, refresh=refresh), downloads))
@@ -3,10 +3,12 @@ import os
 from collections import namedtuple, defaultdict
 
 import pandas as pd
-import requests
 
 from api_data import ApiDataInterface, Tables, Table
-from web_data import ColumnNames, RowDataGetter, DataDescription, Links, WebDataGenerator
+from constants import ColumnNames
+from downloader import Download
+from web_data import DETAIL_SHARD_SIZE, RowDataGetter, DataDescription, Links, WebDataGenerator, PyramidLevel, \
+    child_rows, group_by_position
 
 PersonType = namedtuple('PersonType', ['name', 'category'])
 InjuryType = namedtuple('InjuryType', ['name', 'category', 'number'])
@@ -14,11 +16,16 @@ InjuryType = namedtuple('InjuryType', ['name', 'category', 'number'])
 BASE_URL = 'https://crashviewer.nhtsa.dot.gov/CrashAPI'
 DATA_API = f'{BASE_URL}/FARSData'
 
+KEY_DTYPES = {'CASEYEAR': 'int16', 'STATE': 'int8', 'ST_CASE': 'int32'}
+
 FARS_TABLES = Tables(
     key_columns=['CASEYEAR', 'STATE', 'ST_CASE'],
-    crash=Table(name='Accident', columns=['LATITUDE', 'LONGITUD', 'FATALS']),
-    person=Table(name='Person', columns=['PER_TYP', 'PER_TYPNAME', 'INJ_SEV', 'INJ_SEVNAME', 'AGE']),
-    vehicle=Table(name='Vehicle', columns=[]),
+    crash=Table(name='Accident', columns=['LATITUDE', 'LONGITUD', 'FATALS'],
+                dtypes={**KEY_DTYPES, 'LATITUDE': 'float32', 'LONGITUD': 'float32', 'FATALS': 'int8'}),
+    person=Table(name='Person', columns=['PER_TYP', 'PER_TYPNAME', 'INJ_SEV', 'INJ_SEVNAME', 'AGE'],
+                 dtypes={**KEY_DTYPES, 'PER_TYP': 'int8', 'PER_TYPNAME': 'category', 'INJ_SEV': 'int8',
+                         'INJ_SEVNAME': 'category', 'AGE': 'int16'}),
+    vehicle=Table(name='Vehicle', columns=[], dtypes=KEY_DTYPES, join='count'),
 )
 
 FARS_DATA_DESCRIPTION = DataDescription(
@@ -34,6 +41,11 @@ FARS_DATA_DESCRIPTION = DataDescription(
 
 COLUMN_NAMES = ColumnNames(latitude='LATITUDE', longitude='LONGITUD', year='CASEYEAR')
 
+FARS_PYRAMID = [
+    PyramidLevel(max_zoom=5, latlong_interval=180, cluster_interval=1),
+    PyramidLevel(max_zoom=8, latlong_interval=10, cluster_interval=0.1),
+]
+
 PER_TYPE = {
     1: PersonType('Driver', 'car'),
     2: PersonType('Passenger', 'car'),
@@ -71,6 +83,9 @@ def invert_dict(orig, key):
 
 
 INJURY_TYPE_GROUPS = invert_dict(INJURY_TYPE, 'category')
+INJURY_CATEGORIES = {k: v.category for k, v in INJURY_TYPE.items()}
+PER_TYPE_NAMES = {k: v.name for k, v in PER_TYPE.items()}
+PER_TYPE_CATEGORIES = {k: v.category for k, v in PER_TYPE.items()}
 
 
 def get_person_type(person):
@@ -128,50 +143,95 @@ class FarsRowDataGetter(RowDataGetter):
             injuries[injury_type.category].append(info)
         return injuries
 
+    def item_id_column(self, df):
+        return (df['CASEYEAR'].astype(str) + '-' + df['STATE'].astype(str) + '-' + df['ST_CASE'].astype(str)).tolist()
+
+    def category_column(self, df):
+        people = child_rows(df, 'Person', FARS_TABLES.person.columns)
+        fatal = people[people['INJ_SEV'].map(INJURY_CATEGORIES).fillna(UNKNOWN_INJURY_TYPE.category) == 'fatalities']
+        priorities = fatal['PER_TYP'].map(PER_TYPE_CATEGORIES).fillna(UNKNOWN_PER_TYPE.category).map(
+            {c: i for i, c in enumerate(PER_TYPE_PRIORITIES)})
+        max_priorities = priorities.groupby(level=0).max().reindex(range(len(df)), fill_value=-1)
+        return [PER_TYPE_PRIORITIES[p] if p > -1 else 'other' for p in max_priorities.astype(int).tolist()]
+
+    def num_fatalities_column(self, df):
+        people = child_rows(df, 'Person', FARS_TABLES.person.columns)
+        fatal = pd.to_numeric(people['INJ_SEV']) == 4
+        counts = fatal.groupby(level=0).sum().reindex(range(len(df)), fill_value=0)
+        return df['FATALS'].where(df['FATALS'].notnull(), counts).astype(int).tolist()
+
+    def num_vehicles_column(self, df):
+        return df['Vehicle'].tolist()
+
+    def injuries_column(self, df):
+        people = child_rows(df, 'Person', FARS_TABLES.person.columns)
+        injury_types = [INJURY_TYPE.get(s, UNKNOWN_INJURY_TYPE) for s in people['INJ_SEV']]
+        person_names = people['PER_TYP'].map(PER_TYPE_NAMES).fillna(UNKNOWN_PER_TYPE.name)
+        known_ages = pd.to_numeric(people['AGE'], errors='coerce') < 900
+        infos = []
+        for injury_type, person_name, age, known_age in zip(injury_types, person_names, people['AGE'], known_ages):
+            info = {'person': person_name, 'age': age if known_age else 'unknown'}
+            if len(INJURY_TYPE_GROUPS[injury_type.category]) > 1:
+                info['severity'] = injury_type.name
+            infos.append(info)
+        return group_by_position(people.index, [i.category for i in injury_types], infos, len(df))
+
 
 class FarsApiDataInterface(ApiDataInterface):
-    def __init__(self):
-        super(FarsApiDataInterface, self).__init__(entity='fars', tables=FARS_TABLES)
-        self.years = range(2020, 2021)
+    def __init__(self, years=range(2020, 2021), data_api=DATA_API):
+        super(FarsApiDataInterface, self).__init__(entity='fars', tables=FARS_TABLES, column_names=COLUMN_NAMES)
+        self.years = years
+        self.data_api = data_api
 
-    def download_data(self, refresh=False):
-        if not os.path.exists(self.data_dir()):
-            os.makedirs(self.data_dir())
-        for table in self.tables.get_tables():
-            for year in self.years:
-                output_path = self.downloaded_data_file(table.name, year)
-                if not refresh and os.path.exists(output_path):
-                    continue
-                params = {'dataset': table.name, 'State': '*', 'FromYear': year, 'ToYear': year}
-                response = requests.get(DATA_API, params)
-                response.encoding = 'utf-8-sig'
-                with open(output_path, 'w') as outfile:
-                    outfile.write(response.text)
-
-    def convert_to_df(self):
+    def downloads(self):
+        return [Download(url=self.data_api, path=self.downloaded_data_file(table.name, year),
+                         params={'dataset': table.name, 'State': '*', 'FromYear': year, 'ToYear': year})
+                for table in self.tables.get_tables() for year in self.years]
+
+    def source_files(self, years=None):
+        return [self.downloaded_data_file(table.name, year)
+                for table in self.tables.get_tables() for year in (self.years if years is None else years)]
+
+    def convert_to_df(self, years=None):
         for table in self.tables.get_tables():
-            for year in self.years:
-                df = pd.read_csv(self.downloaded_data_file(table.name, year))
-                df.to_pickle(self.unfiltered_data_file(table.name, year))
+            for year in self.years if years is None else years:
+                df = self.read_csv(self.downloaded_data_file(table.name, year), table)
+                self.write_df(df, self.unfiltered_data_file(table.name, year))
+
+    def pipeline_years(self):
+        return list(self.years)
+
+    def converts_by_year(self):
+        return True
 
     def downloaded_data_file(self, dataset_name, year):
         return f'{self.data_dir()}/{dataset_name.lower()}-{year}.csv'
 
     def merged_data_file(self, year):
-        return f'{self.data_dir()}/df-{year}.pkl'
-
-    def convert_data_types(self, df, dataset: Table = None):
-        for col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='ignore')
+        return f'{self.data_dir()}/df-{year}{self.storage.suffix}'
 
 
 if __name__ == '__main__':
-    data_interface = FarsApiDataInterface()
-    data_interface.process_data(year=2020)
-    df = data_interface.read_data()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Processes the FARS data of the given years and generates the web '
+                                                 'data.')
+    parser.add_argument('--first-year', type=int, default=2020)
+    parser.add_argument('--last-year', type=int, default=2020)
+    parser.add_argument('--workers', type=int, help='Years processed at once; defaults to the number of CPUs')
+    args = parser.parse_args()
+
+    data_interface = FarsApiDataInterface(years=range(args.first_year, args.last_year + 1))
+    data_interface.process_data(workers=args.workers)
+    df = data_interface.read_data(years=(args.first_year, args.last_year))
 
     print('Generating web data...')
     web_data_generator = WebDataGenerator(row_data_getter=FarsRowDataGetter(column_names=COLUMN_NAMES),
                                           column_names=COLUMN_NAMES,
-                                          data_description=FARS_DATA_DESCRIPTION)
-    web_data_generator.iterate_and_save(df, latlong_interval=2)
+                                          data_description=FARS_DATA_DESCRIPTION,
+                                          binary_tiles=True,
+                                          pyramid=FARS_PYRAMID,
+                                          detail_shard_size=DETAIL_SHARD_SIZE,
+                                          report=data_interface.report)
+    web_data_generator.iterate_and_save(df, latlong_interval=2, workers=os.cpu_count(), incremental=True)
+    data_interface.report.write(f'{data_interface.data_dir()}/run-report.json')
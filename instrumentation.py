@@ -0,0 +1,146 @@
+import cProfile
+import fnmatch
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+COUNTS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+@dataclass
+class StageMetrics:
+    name: str
+    wall_seconds: float = 0
+    cpu_seconds: float = 0
+    # Peak resident memory of the process the stage ran in, as of the stage's end.
+    peak_rss_bytes: int = None
+    rows_in: int = 0
+    rows_out: int = 0
+    # What reads actually took after projection and pushdown: whole CSVs and pickles, the compressed column chunks of
+    # the Parquet row groups not skipped, and the Arrow size of the columns read from Feather.
+    bytes_read: int = 0
+    bytes_written: int = 0
+    skipped: bool = False
+
+
+@dataclass
+class TileMetrics:
+    name: str
+    rows: int
+    seconds: float
+    bytes_written: int
+
+
+# Collects metrics of (possibly nested) stages and of individual tiles. Stages whose name matches one of the
+# `profile` patterns also run under a profiler: pyinstrument's sampling profiler if it is installed, else cProfile, a
+# deterministic tracing profiler that hooks every call, so it slows the profiled stage down far more and inflates the
+# share of functions making many small calls.
+@dataclass
+class RunReport:
+    profile: list = None
+    profile_dir: str = 'profiles'
+    stages: list = field(default_factory=list)
+    tiles: list = field(default_factory=list)
+    open_stages: list = field(default_factory=list, repr=False)
+
+    @contextmanager
+    def stage(self, name):
+        metrics = StageMetrics(name=name)
+        self.open_stages.append(metrics)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with self.profiled(name):
+                yield metrics
+        finally:
+            metrics.wall_seconds = time.perf_counter() - wall
+            metrics.cpu_seconds = time.process_time() - cpu
+            metrics.peak_rss_bytes = peak_rss()
+            self.open_stages.pop()
+            # Enclosing stages include their nested stages' counts.
+            if self.open_stages:
+                self.count(**{c: getattr(metrics, c) for c in COUNTS})
+            self.stages.append(metrics)
+
+    def count(self, **counts):
+        if self.open_stages:
+            metrics = self.open_stages[-1]
+            for name, value in counts.items():
+                setattr(metrics, name, getattr(metrics, name) + int(value))
+
+    def skip(self, name):
+        self.stages.append(StageMetrics(name=name, skipped=True))
+
+    def merge(self, stages: list = (), tiles: list = ()):
+        self.stages += stages
+        self.tiles += tiles
+
+    @contextmanager
+    def profiled(self, name):
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in self.profile or []):
+            yield
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = f'{self.profile_dir}/{name.replace("/", "-")}'
+        if pyinstrument is not None:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(f'{path}.txt', 'w') as outfile:
+                    outfile.write(profiler.output_text())
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f'{path}.prof')
+
+    def slowest_tiles(self, count=10):
+        return sorted(self.tiles, key=lambda t: t.seconds, reverse=True)[:count]
+
+    def to_dict(self):
+        return {
+            'stages': [asdict(s) for s in self.stages],
+            'tiles': [asdict(t) for t in self.tiles],
+            'slowest_tiles': [t.name for t in self.slowest_tiles()],
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=2)
+
+    def summary(self):
+        return '\n'.join(
+            f'{s.name}: skipped' if s.skipped else
+            f'{s.name}: {s.wall_seconds:.2f}s wall, {s.cpu_seconds:.2f}s CPU, {s.rows_in} -> {s.rows_out} rows, '
+            f'{s.bytes_read / 2 ** 20:.1f} MiB read, {s.bytes_written / 2 ** 20:.1f} MiB written'
+            for s in self.stages)
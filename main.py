@@ -1,51 +1,53 @@
-import glob
-import json
-
 import pandas as pd
 import requests
 
-from api_data import ApiDataInterface, Table, Tables
-from fars import COLUMN_NAMES, FARS_DATA_DESCRIPTION
+from api_data import ApiDataInterface
+from fars import COLUMN_NAMES, FARS_DATA_DESCRIPTION, FARS_PYRAMID, FARS_TABLES
 from fars import FarsRowDataGetter
-from web_data import WebDataGenerator
+from response_cache import ResponseCache
+from web_data import DETAIL_SHARD_SIZE, WebDataGenerator
 
 BASE_URL = 'https://crashviewer.nhtsa.dot.gov/CrashAPI'
 CRASH_API = f'{BASE_URL}/crashes'
 DATA_API = f'{BASE_URL}/FARSData'
 
 
+RESPONSE_CACHE_FILE = 'cache/responses.sqlite'
+RESPONSE_CACHE = None
+
+
+# Opened on first use, so importing this module doesn't create the cache directory and database.
+def get_response_cache():
+    global RESPONSE_CACHE
+    if RESPONSE_CACHE is None:
+        RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_FILE)
+    return RESPONSE_CACHE
+
+
+def fetch_fars_api(api, params):
+    return requests.get(api, params={**params, 'format': 'json'}).json()
+
+
 def query_fars_api(api, params, force_cache_update=False):
-    def get_filename():
-        inner_name = None
-        if api == 'GetCrashesByLocation':
-            inner_name = 'GetCrashesByLocation'
-        elif api == 'GetCaseDetails':
-            inner_name = f'GetCaseDetails-{params["caseYear"]}-{params["stateCase"]}'
-        elif api == 'GetFARSData':
-            inner_name = f'GetFARSData-{params["dataset"]}-{params["caseYear"]}'
-        return f'cache/{inner_name}.json' if inner_name else None
-
-    filename = get_filename()
-    if not force_cache_update and filename:
-        try:
-            with open(filename) as infile:
-                return json.load(infile)
-        except IOError:
-            pass
-    params['format'] = 'json'
-    response = requests.get(api, params=params).json()
-    if filename:
-        with open(filename, 'w') as outfile:
-            json.dump(response, outfile)
+    if not force_cache_update:
+        response = get_response_cache().get(api, params)
+        if response is not None:
+            return response
+    response = fetch_fars_api(api, params)
+    get_response_cache().put(api, params, response)
     return response
 
 
-FARS_TABLES = Tables(
-    key_columns=['CASEYEAR', 'STATE', 'ST_CASE'],
-    crash=Table(name='Accident', columns=['LATITUDE', 'LONGITUD', 'FATALS']),
-    person=Table(name='Person', columns=['PER_TYP', 'PER_TYPNAME', 'INJ_SEV', 'INJ_SEVNAME', 'AGE']),
-    vehicle=Table(name='Vehicle', columns=[]),
-)
+def query_fars_api_many(api, params_list, force_cache_update=False, batch_size=8):
+    responses = [None] * len(params_list) if force_cache_update else get_response_cache().get_many(api, params_list)
+    missing = [i for i, response in enumerate(responses) if response is None]
+    # Cached a batch at a time as they arrive, so an error part way through keeps the responses already fetched.
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for i in batch:
+            responses[i] = fetch_fars_api(api, params_list[i])
+        get_response_cache().put_many(api, [(params_list[i], responses[i]) for i in batch])
+    return responses
 
 
 def refresh_data_from_server(year):
@@ -64,42 +66,63 @@ def convert_to_df(year):
 
 
 class FarsApiDataInterface(ApiDataInterface):
-    def __init__(self):
-        super(FarsApiDataInterface, self).__init__(entity='fars', tables=FARS_TABLES)
-
-    def convert_to_df(self):
-        pass
+    def __init__(self, years=range(2010, 2019)):
+        super(FarsApiDataInterface, self).__init__(entity='fars', tables=FARS_TABLES, column_names=COLUMN_NAMES)
+        self.years = years
+
+    def pipeline_years(self):
+        return list(self.years)
+
+    def converts_by_year(self):
+        return True
+
+    # Responses come from the API (through the response cache) rather than from downloaded files.
+    def source_files(self, years=None):
+        return []
+
+    def convert_to_df(self, years=None):
+        years = self.years if years is None else years
+        keys = [(table, year) for table in self.tables.get_tables() for year in years]
+        # One batched cache lookup for every table and year; only the misses go to the API.
+        responses = query_fars_api_many(api=f'{DATA_API}/GetFARSData',
+                                        params_list=[{'dataset': table.name, 'caseYear': year} for table, year in keys])
+        for (table, year), response in zip(keys, responses):
+            df = pd.DataFrame(response['Results'][0])
+            df.columns = [c.upper() for c in df.columns]
+            self.write_df(df, self.unfiltered_data_file(table.name, year))
+
+    def code_dependencies(self):
+        return super(FarsApiDataInterface, self).code_dependencies() + [query_fars_api_many]
 
     def merged_data_file(self, year):
-        return f'{self.data_dir()}/df-{year}.pkl'
-
-    def convert_data_types(self, df, dataset: Table = None):
-        for col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='ignore')
+        return f'{self.data_dir()}/df-{year}{self.storage.suffix}'
 
 
-def generate_web_data():
-    df = FarsApiDataInterface().read_data()
+def generate_web_data(years=range(2010, 2019)):
+    df = FarsApiDataInterface(years=years).read_data(years=(min(years), max(years)))
 
     web_data_generator = WebDataGenerator(row_data_getter=FarsRowDataGetter(),
                                           column_names=COLUMN_NAMES,
-                                          data_description=FARS_DATA_DESCRIPTION)
-    web_data_generator.iterate_and_save(df, latlong_interval=2)
+                                          data_description=FARS_DATA_DESCRIPTION,
+                                          binary_tiles=True,
+                                          pyramid=FARS_PYRAMID,
+                                          detail_shard_size=DETAIL_SHARD_SIZE)
+    web_data_generator.iterate_and_save(df, latlong_interval=2, incremental=True)
 
 
 if __name__ == '__main__':
-    years = range(2010, 2019)
-    for _year in years:
-        print(f'Starting year {_year}...')
-        # print('Refreshing data...')
-        # refresh_data_from_server(year=_year)
-        # print('Converting data to df...')
-        # convert_to_df(year=_year)
-        # print('Filtering data...')
-        # filter_data(year=_year)
-        # print('Merging data...')
-        # merge_data(year=_year)
-        pass
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--first-year', type=int, default=2010)
+    parser.add_argument('--last-year', type=int, default=2018)
+    parser.add_argument('--workers', type=int, help='Years processed at once; defaults to the number of CPUs')
+    args = parser.parse_args()
+    fars_years = range(args.first_year, args.last_year + 1)
+
+    # Each year is converted, filtered and merged in its own worker process, and only the stages whose inputs,
+    # declarations or code changed since the last run are run again.
+    FarsApiDataInterface(years=fars_years).process_data(workers=args.workers)
     print('Generating web data...')
-    generate_web_data()
+    generate_web_data(fars_years)
     print('Done.')
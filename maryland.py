@@ -2,13 +2,17 @@ import math
 from collections import defaultdict
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 from api_data import ApiDataInterface, Table, Tables
-from constants import InjuryType, PersonType, UNKNOWN, CrashCategory
-from web_data import ColumnNames, WebDataGenerator, RowDataGetter, DataDescription, Links
+from constants import ColumnNames, InjuryType, PersonType, UNKNOWN, CrashCategory
+from web_data import WebDataGenerator, RowDataGetter, DataDescription, Links, child_rows, \
+    group_by_position, most_severe_category
 
 DATE_OF_BIRTH_COLUMN = 'DATE_OF_BIRTH'
+CRASH_DATE_COLUMN = 'ACC_DATE'
+AGE_COLUMN = 'AGE'
 INJURY_SEVERITY_COLUMN = 'INJ_SEVER_CODE'
 PERSON_TYPE_COLUMN = 'PERSON_TYPE'
 
@@ -24,10 +28,14 @@ MARYLAND_TABLES = Tables(
     key_columns=['REPORT_NO'],
     crash=Table(name='Crash',
                 columns=['REPORT_TYPE', 'HARM_EVENT_DESC1', 'HARM_EVENT_DESC2', 'LATITUDE', 'LONGITUDE',
-                         'YEAR', 'ACC_DATE']),
+                         'YEAR', 'ACC_DATE'],
+                dtypes={'REPORT_TYPE': 'category', 'HARM_EVENT_DESC1': 'category', 'HARM_EVENT_DESC2': 'category',
+                        'LATITUDE': 'float32', 'LONGITUDE': 'float32', 'YEAR': 'int16', 'ACC_DATE': str},
+                filters=[('REPORT_TYPE', 'in', ['Fatal Crash', 'Injury Crash'])]),
     person=Table(name='Person',
-                 columns=[PERSON_TYPE_COLUMN, INJURY_SEVERITY_COLUMN, DATE_OF_BIRTH_COLUMN]),
-    vehicle=Table(name='Vehicle', columns=[]),
+                 columns=[PERSON_TYPE_COLUMN, INJURY_SEVERITY_COLUMN, DATE_OF_BIRTH_COLUMN],
+                 dtypes={PERSON_TYPE_COLUMN: 'category', INJURY_SEVERITY_COLUMN: 'int8', DATE_OF_BIRTH_COLUMN: str}),
+    vehicle=Table(name='Vehicle', columns=[], join='count'),
 )
 
 COLUMN_NAMES = ColumnNames(latitude='LATITUDE', longitude='LONGITUDE', year='YEAR', id='REPORT_NO')
@@ -67,29 +75,40 @@ def person_type(person):
 
 class MarylandApiDataInterface(ApiDataInterface):
     def __init__(self):
-        super(MarylandApiDataInterface, self).__init__(entity='maryland', tables=MARYLAND_TABLES)
+        super(MarylandApiDataInterface, self).__init__(entity='maryland', tables=MARYLAND_TABLES,
+                                                       column_names=COLUMN_NAMES)
+
+    def tables_to_files(self):
+        tables_to_filenames = [
+            (self.tables.crash, 'Maryland_Statewide_Vehicle_Crashes.csv'),
+            (self.tables.person, 'Maryland_Statewide_Vehicle_Crashes_-_Person_Details__Anonymized_.csv'),
+            (self.tables.vehicle, 'Maryland_Statewide_Vehicle_Crashes_-_Vehicle_Details.csv'),
+        ]
+        return [(table, f'{self.data_dir()}/{filename}') for table, filename in tables_to_filenames]
+
+    def source_files(self):
+        return [path for _, path in self.tables_to_files()]
 
     def convert_to_df(self):
-        datasets_to_filenames = {
-            self.tables.crash.name: 'Maryland_Statewide_Vehicle_Crashes.csv',
-            self.tables.person.name: 'Maryland_Statewide_Vehicle_Crashes_-_Person_Details__Anonymized_.csv',
-            self.tables.vehicle.name: 'Maryland_Statewide_Vehicle_Crashes_-_Vehicle_Details.csv',
-        }
-
-        for table, filename in datasets_to_filenames.items():
-            df = pd.read_csv(f'{self.data_dir()}/{filename}')
-            df.to_pickle(self.unfiltered_data_file(table, year='all'))
-
-    def filter_rows(self, df, dataset: Table = None):
-        if dataset.name == 'Crash':
-            return df.loc[(df['REPORT_TYPE'] == 'Fatal Crash') | (df['REPORT_TYPE'] == 'Injury Crash')]
-        return df
+        for table, path in self.tables_to_files():
+            df = self.read_csv(path, table)
+            self.write_df(df, self.unfiltered_data_file(table.name, year='all'))
 
     def convert_data_types(self, df, dataset: Table = None):
-        if dataset.name == 'Crash':
-            df['ACC_DATE'] = df['ACC_DATE'].astype(str)
+        df = super(MarylandApiDataInterface, self).convert_data_types(df, dataset)
+        date_column = {'Crash': CRASH_DATE_COLUMN, 'Person': DATE_OF_BIRTH_COLUMN}.get(dataset.name)
+        if date_column:
+            df = df.assign(**{date_column: parse_dates(df[date_column])})
+        return df
+
+    def code_dependencies(self):
+        return super(MarylandApiDataInterface, self).code_dependencies() + [parse_dates, ages]
+
+    def add_child_columns(self, crash_df, df, dataset: Table):
         if dataset.name == 'Person':
-            df[DATE_OF_BIRTH_COLUMN] = df[DATE_OF_BIRTH_COLUMN].astype(str)
+            crash_dates = crash_df[CRASH_DATE_COLUMN].reindex(df[self.key_columns[0]])
+            df = df.assign(**{AGE_COLUMN: ages(df[DATE_OF_BIRTH_COLUMN], crash_dates)})
+        return df
 
 
 def safe_int(maybe_nan):
@@ -99,6 +118,8 @@ def safe_int(maybe_nan):
 
 
 def parse_date(date_str):
+    if isinstance(date_str, datetime) or pd.isnull(date_str):
+        return UNKNOWN if pd.isnull(date_str) else date_str
     if not date_str or date_str == 'nan' or date_str == '1/1/1900':
         return UNKNOWN
     for suffix in ['.0', ' 00:00:00', ' ']:
@@ -117,7 +138,33 @@ def age(birth_date_str: str, crash_date_str: str):
     if birth_date == UNKNOWN or crash_date == UNKNOWN:
         return UNKNOWN
 
-    return crash_date.year - birth_date.year - ((crash_date.month, birth_date.day) < (crash_date.month, birth_date.day))
+    return crash_date.year - birth_date.year - ((crash_date.month, crash_date.day) < (birth_date.month, birth_date.day))
+
+
+# parse_date over a whole column: each format is parsed in bulk for the values it applies to, and values parse_date
+# can't read become NaT.
+def parse_dates(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = values.astype(object).fillna('').astype(str)
+    unknown = text.isin(['', 'nan', '1/1/1900'])
+    for suffix in ['.0', ' 00:00:00', ' ']:
+        text = text.where(~text.str.endswith(suffix), text.str[:-len(suffix)])
+    numeric = text.str.isnumeric()
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for date_format, selected in [('%Y%m%d', numeric & ~unknown), ('%d-%b-%y', ~numeric & ~unknown)]:
+        if selected.any():
+            dates[selected] = pd.to_datetime(text[selected], format=date_format, errors='coerce')
+    return dates
+
+
+def ages(birth_dates: pd.Series, crash_dates: pd.Series) -> pd.Series:
+    index = birth_dates.index
+    birth_dates = pd.DatetimeIndex(parse_dates(birth_dates))
+    crash_dates = pd.DatetimeIndex(parse_dates(pd.Series(crash_dates.to_numpy())))
+    before_birthday = crash_dates.month * 100 + crash_dates.day < birth_dates.month * 100 + birth_dates.day
+    years = crash_dates.year - birth_dates.year - before_birthday
+    return pd.Series(np.asarray(years), index=index).astype('Int16')
 
 
 class MarylandRowDataGetter(RowDataGetter):
@@ -148,19 +195,51 @@ class MarylandRowDataGetter(RowDataGetter):
         for p in row['Person']:
             info = {
                 'person': person_type(p).value.description,
-                'age': age(p[DATE_OF_BIRTH_COLUMN], row['ACC_DATE']),
+                'age': age(p[DATE_OF_BIRTH_COLUMN], row[CRASH_DATE_COLUMN]),
             }
             injuries[injury_type(p).value.category.value].append(info)
         return injuries
 
+    @staticmethod
+    def people(df):
+        people = child_rows(df, 'Person', MARYLAND_TABLES.person.columns + [AGE_COLUMN])
+        person_types = people[PERSON_TYPE_COLUMN].map(PERSON_TYPE_CODE_TO_PERSON)
+        injury_types = people[INJURY_SEVERITY_COLUMN].map(INJURY_CODE_TO_INJURY)
+        return people, person_types, injury_types
+
+    def category_column(self, df):
+        people, person_types, injury_types = self.people(df)
+        categories = most_severe_category(injury_types, person_types, len(df), None)
+        harm = df['HARM_EVENT_DESC1'].map(HARM)
+        return [h.value if isinstance(h, CrashCategory) else c for h, c in zip(harm, categories)]
+
+    def num_vehicles_column(self, df):
+        return pd.to_numeric(df['Vehicle'], errors='coerce').fillna(0).astype(int).tolist()
+
+    def num_fatalities_column(self, df):
+        people, person_types, injury_types = self.people(df)
+        fatal = injury_types == InjuryType.FATALITY
+        return fatal.groupby(level=0).sum().reindex(range(len(df)), fill_value=0).astype(int).tolist()
+
+    def injuries_column(self, df):
+        people, person_types, injury_types = self.people(df)
+        person_ages = people[AGE_COLUMN]
+        # Ages are computed when merging; records merged before that only have the dates.
+        if person_ages.isnull().all():
+            crash_dates = df[CRASH_DATE_COLUMN].iloc[people.index]
+            person_ages = ages(people[DATE_OF_BIRTH_COLUMN], crash_dates)
+        infos = [{'person': p.value.description, 'age': UNKNOWN if pd.isnull(a) else int(a)}
+                 for p, a in zip(person_types, person_ages)]
+        return group_by_position(people.index, [i.value.category.value for i in injury_types], infos, len(df))
+
 
 if __name__ == '__main__':
     data_interface = MarylandApiDataInterface()
-    # data_interface.process_data(year='all')
+    # data_interface.process_data()
     df = data_interface.read_data()
 
     print('Generating web data...')
     web_data_generator = WebDataGenerator(row_data_getter=MarylandRowDataGetter(column_names=COLUMN_NAMES),
                                           column_names=COLUMN_NAMES,
                                           data_description=MARYLAND_DATA_DESCRIPTION)
-    web_data_generator.iterate_and_save(df, latlong_interval=2)
+    web_data_generator.iterate_and_save(df, latlong_interval=2, incremental=True)
@@ -0,0 +1,160 @@
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from instrumentation import RunReport
+
+PIPELINE_STATE_FILE = 'data.nosync/pipeline.json'
+
+
+# One stage of one source: calls function(*args), reading `inputs` and writing `outputs`. It runs only after the nodes
+# named in `dependencies`, and only if its fingerprint changed since it last ran.
+@dataclass
+class Node:
+    name: str
+    function: object
+    args: tuple = ()
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    dependencies: list = field(default_factory=list)
+    # Anything else the outputs depend on: declarations, the version of the code, ...
+    params: dict = field(default_factory=dict)
+
+
+def hash_bytes(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Hashes the source of the given modules, classes and functions, so editing the code a stage runs invalidates it. Only
+# what is listed counts: editing code the stage doesn't run leaves it up to date.
+def code_version(*code):
+    digest = hashlib.sha256()
+    for obj in code:
+        digest.update(inspect.getsource(obj).encode())
+    return digest.hexdigest()
+
+
+# Runs a node in a worker, returning the metrics of its stage and any stages nested in it. Stages record into the
+# report of the node's object (a copy of it, in the worker) when it has one, so they can count rows and bytes.
+def run_node(node: Node):
+    report = getattr(getattr(node.function, '__self__', None), 'report', None) or RunReport()
+    start = len(report.stages)
+    with report.stage(node.name):
+        node.function(*node.args)
+    return report.stages[start:]
+
+
+class Pipeline:
+    def __init__(self, state_file=PIPELINE_STATE_FILE, workers: int = None, report: RunReport = None):
+        self.state_file = state_file
+        self.workers = workers or os.cpu_count()
+        self.report = report or RunReport()
+        try:
+            with open(state_file) as infile:
+                self.state = json.load(infile)
+        except (IOError, ValueError):
+            self.state = {}
+        self.state.setdefault('nodes', {})
+        self.state.setdefault('files', {})
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        with open(self.state_file, 'w') as outfile:
+            json.dump(self.state, outfile)
+
+    # Content hash of a file, remembered by size and modification time so unchanged files aren't read again.
+    def file_hash(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cached = self.state['files'].get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+        self.state['files'][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, node: Node):
+        inputs = {path: self.file_hash(path) for path in node.inputs}
+        return hash_bytes(json.dumps([node.name, inputs, node.params], sort_keys=True, default=str).encode())
+
+    def up_to_date(self, node: Node, fingerprint):
+        return self.state['nodes'].get(node.name) == fingerprint and all(os.path.exists(p) for p in node.outputs)
+
+    def finish(self, node: Node, fingerprint):
+        missing = [p for p in node.outputs if not os.path.exists(p)]
+        if missing:
+            raise ValueError(f'{node.name} did not write {", ".join(missing)}')
+        self.state['nodes'][node.name] = fingerprint
+        self.save_state()
+
+    # Runs every node whose fingerprint changed, each as soon as its dependencies are done, up to `workers` at a time.
+    def run(self, nodes: list, force: bool = False):
+        pending = {node.name: node for node in nodes}
+        unknown = {d for node in nodes for d in node.dependencies if d not in pending}
+        if unknown:
+            raise ValueError(f'Unknown dependencies {", ".join(sorted(unknown))}')
+        done = set()
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                ready = [node for node in pending.values() if all(d in done for d in node.dependencies)]
+                while ready:
+                    node = ready.pop()
+                    del pending[node.name]
+                    # Fingerprinted only now, since the inputs are the outputs of the dependencies.
+                    fingerprint = self.fingerprint(node)
+                    if force or not self.up_to_date(node, fingerprint):
+                        print(f'{node.name}: running')
+                        running[pool.submit(run_node, node)] = (node, fingerprint)
+                        continue
+                    print(f'{node.name}: up to date')
+                    self.report.skip(node.name)
+                    done.add(node.name)
+                    ready += [n for n in pending.values() if n not in ready and all(d in done for d in n.dependencies)]
+                if not running:
+                    if pending:
+                        raise ValueError(f'Dependency cycle among {", ".join(sorted(pending))}')
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node, fingerprint = running.pop(future)
+                    self.report.merge(stages=future.result())
+                    self.finish(node, fingerprint)
+                    done.add(node.name)
+        self.save_state()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from dc import DcApiDataInterface
+    from fars import FarsApiDataInterface
+    from maryland import MarylandApiDataInterface
+    from storage import DEFAULT_STORAGE, STORAGES, get_storage
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--report', default='data.nosync/run-report.json')
+    parser.add_argument('--profile', nargs='*', help='Stages to profile, e.g. "*/merge/*"')
+    parser.add_argument('--storage', choices=list(STORAGES), help=f'Defaults to {DEFAULT_STORAGE}')
+    parser.add_argument('--fars-years', type=int, nargs=2, default=[2020, 2020], metavar=('FIRST', 'LAST'))
+    args = parser.parse_args()
+
+    run_report = RunReport(profile=args.profile)
+    apis = [FarsApiDataInterface(years=range(args.fars_years[0], args.fars_years[1] + 1)), DcApiDataInterface(),
+            MarylandApiDataInterface()]
+    for api in apis:
+        api.report = run_report
+        api.storage = get_storage(args.storage)
+    Pipeline(workers=args.workers, report=run_report).run([node for api in apis for node in api.pipeline_nodes()],
+                                                          force=args.force)
+    print(run_report.summary())
+    run_report.write(args.report)
@@ -0,0 +1,360 @@
+import asyncio
+import glob
+import io
+import json
+import math
+import os
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from child_tables import child_row_positions, child_tables, with_child_tables
+from constants import CrashCategory
+from web_data import HARM_CATEGORIES, RowDataGetter, write_binary_tile, write_point_features
+
+QUERY_INDEX_VERSION = 1
+QUERY_INDEX_COLUMNS = ['longitude', 'latitude', 'year', 'harm', 'num_fatalities', 'id']
+DEFAULT_CELL_SIZE = 0.1
+DEFAULT_CACHE_BYTES = 64 << 20
+MAX_RESULTS = 200000
+FORMATS = {'geojson': 'application/geo+json', 'binary': 'application/octet-stream'}
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}
+
+
+def grid_rows(latitudes, cell_size):
+    return np.floor((np.clip(np.asarray(latitudes, dtype=float), -90, 90) + 90) / cell_size).astype(np.int64)
+
+
+def grid_columns(longitudes, cell_size):
+    return np.floor((np.clip(np.asarray(longitudes, dtype=float), -180, 180) + 180) / cell_size).astype(np.int64)
+
+
+def cells_per_row(cell_size):
+    return math.ceil(360 / cell_size) + 1
+
+
+# Key of the grid cell of each point; the cells of one grid row have consecutive keys.
+def grid_keys(latitudes, longitudes, cell_size):
+    return grid_rows(latitudes, cell_size) * cells_per_row(cell_size) + grid_columns(longitudes, cell_size)
+
+
+# Crash columns sorted by grid cell of `cell_size` degrees and saved as .npy files that are memory-mapped when loaded,
+# so a bbox query only pages in the rows of the cells it overlaps. `cells` holds the sorted keys of the non-empty
+# cells and `offsets` where each one's rows start.
+class CrashIndex:
+    def __init__(self, columns: dict, cells: np.ndarray, offsets: np.ndarray, meta: dict):
+        self.columns = columns
+        self.cells = cells
+        self.offsets = offsets
+        self.meta = meta
+        self.cell_size = meta['cell_size']
+
+    @staticmethod
+    def build(df: pd.DataFrame, row_data_getter: RowDataGetter, directory, cell_size=DEFAULT_CELL_SIZE,
+              source: list = None):
+        column_names = row_data_getter.column_names
+        df = with_child_tables(df.reset_index(), child_tables(df))
+        harm_codes = {h: i for i, h in enumerate(HARM_CATEGORIES)}
+        other = harm_codes[CrashCategory.OTHER.value]
+        columns = {
+            'longitude': pd.to_numeric(df[column_names.longitude], errors='coerce').to_numpy(dtype=float),
+            'latitude': pd.to_numeric(df[column_names.latitude], errors='coerce').to_numpy(dtype=float),
+            'year': pd.to_numeric(df[column_names.year], errors='coerce').to_numpy(dtype=float),
+            'harm': np.array([harm_codes.get(h, other) for h in row_data_getter.category_column(df)], dtype=np.uint8),
+            'num_fatalities': np.nan_to_num(np.asarray(row_data_getter.num_fatalities_column(df), dtype=float)),
+            'id': np.char.encode(np.array([str(i) for i in row_data_getter.item_id_column(df)], dtype=str), 'utf-8'),
+        }
+        valid = np.isfinite(columns['longitude']) & np.isfinite(columns['latitude']) & np.isfinite(columns['year'])
+        columns['year'] = columns['year'].astype(np.int16)
+        columns['num_fatalities'] = columns['num_fatalities'].astype(np.int16)
+
+        meta = {'version': QUERY_INDEX_VERSION, 'cell_size': cell_size, 'source': source, 'rows': int(valid.sum())}
+        keys = grid_keys(columns['latitude'][valid], columns['longitude'][valid], cell_size)
+        order = np.flatnonzero(valid)[np.argsort(keys, kind='stable')]
+        cells, starts = np.unique(np.sort(keys, kind='stable'), return_index=True)
+        arrays = {**{name: columns[name][order] for name in QUERY_INDEX_COLUMNS},
+                  'cells': cells, 'offsets': np.append(starts, len(order)).astype(np.int64)}
+        if len(order):
+            meta['years'] = [int(arrays['year'].min()), int(arrays['year'].max())]
+
+        os.makedirs(directory, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(f'{directory}/{name}.npy', values)
+        # Written last, so an interrupted build is rebuilt next time.
+        with open(f'{directory}/meta.json', 'w') as outfile:
+            json.dump(meta, outfile)
+        return CrashIndex.load(directory)
+
+    @staticmethod
+    def load(directory):
+        with open(f'{directory}/meta.json') as infile:
+            meta = json.load(infile)
+        arrays = {name: np.load(f'{directory}/{name}.npy', mmap_mode='r')
+                  for name in QUERY_INDEX_COLUMNS + ['cells', 'offsets']}
+        return CrashIndex({name: arrays[name] for name in QUERY_INDEX_COLUMNS}, np.asarray(arrays['cells']),
+                          np.asarray(arrays['offsets']), meta)
+
+    # Positions of the crashes inside `bbox` (west, south, east, north), in the `years` range (inclusive) and with
+    # one of the `harms`.
+    def positions(self, bbox, years=None, harms=None):
+        west, south, east, north = bbox
+        # The bbox's cells in each grid row have consecutive keys, so their crashes are one slice of the index.
+        rows = np.arange(grid_rows(south, self.cell_size), grid_rows(north, self.cell_size) + 1)
+        first_cells = rows * cells_per_row(self.cell_size) + grid_columns(west, self.cell_size)
+        last_cells = rows * cells_per_row(self.cell_size) + grid_columns(east, self.cell_size)
+        starts = self.offsets[np.searchsorted(self.cells, first_cells, side='left')]
+        ends = self.offsets[np.searchsorted(self.cells, last_cells, side='right')]
+        _, candidates = child_row_positions(starts, ends - starts)
+
+        longitudes = self.columns['longitude'][candidates]
+        latitudes = self.columns['latitude'][candidates]
+        matches = (longitudes >= west) & (longitudes <= east) & (latitudes >= south) & (latitudes <= north)
+        if years is not None:
+            year = self.columns['year'][candidates]
+            matches &= (year >= years[0]) & (year <= years[1])
+        if harms is not None:
+            matches &= np.isin(self.columns['harm'][candidates], [HARM_CATEGORIES.index(h) for h in harms])
+        return candidates[matches]
+
+    def write_geojson(self, positions):
+        outfile = io.StringIO()
+        write_point_features(outfile, self.columns['longitude'][positions].tolist(),
+                             self.columns['latitude'][positions].tolist(), {
+                                 'id': np.char.decode(self.columns['id'][positions], 'utf-8').tolist(),
+                                 'year': self.columns['year'][positions].tolist(),
+                                 'harm': [HARM_CATEGORIES[h] for h in self.columns['harm'][positions].tolist()],
+                                 'num_fatalities': self.columns['num_fatalities'][positions].tolist(),
+                             })
+        return outfile.getvalue().encode('utf-8')
+
+    # The packed columnar tile format of web_data.write_binary_tile, which web/tiles.js decodes.
+    def write_binary(self, positions):
+        outfile = io.BytesIO()
+        write_binary_tile(outfile, self.columns['longitude'][positions], self.columns['latitude'][positions],
+                          np.char.decode(self.columns['id'][positions], 'utf-8').tolist(),
+                          self.columns['year'][positions],
+                          [HARM_CATEGORIES[h] for h in self.columns['harm'][positions].tolist()],
+                          self.columns['num_fatalities'][positions])
+        return outfile.getvalue()
+
+
+def query_index_dir(api):
+    return f'{api.data_dir()}/query-index'
+
+
+# Size and modification time of every merged partition and child table file, to tell when the index is stale.
+def merged_files_state(api):
+    merged = sorted(glob.glob(api.merged_data_file('*')))
+    paths = merged + [api.child_data_file(t.name, f) for f in merged for t in api.tables.get_tables()
+                      if t is not api.tables.crash and t.join == 'columnar']
+    return [[p, os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths if os.path.exists(p)]
+
+
+# The source's index, rebuilt from `api.read_data()` when the merged data or the cell size changed since it was built.
+def load_index(api, row_data_getter: RowDataGetter, cell_size=DEFAULT_CELL_SIZE, rebuild: bool = False):
+    directory = query_index_dir(api)
+    source = merged_files_state(api)
+    try:
+        with open(f'{directory}/meta.json') as infile:
+            meta = json.load(infile)
+    except (IOError, ValueError):
+        meta = {}
+    expected = {'version': QUERY_INDEX_VERSION, 'cell_size': cell_size, 'source': source}
+    if not rebuild and all(meta.get(k) == v for k, v in expected.items()):
+        return CrashIndex.load(directory)
+    print(f'Building the {api.entity} query index...')
+    return CrashIndex.build(api.read_data(), row_data_getter, directory, cell_size=cell_size, source=source)
+
+
+# Least recently used responses, up to `max_bytes` in total.
+class LruCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += len(value)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+# The normalized query a request asks for, which is also its cache key:
+# source, (west, south, east, north), (first year, last year) or None, sorted harms or None, format.
+def parse_query(params: dict, sources):
+    def param(name, default=None):
+        values = params.get(name)
+        if not values and default is None:
+            raise ValueError(f'Missing parameter {name}')
+        return values[-1] if values else default
+
+    source = param('source')
+    if source not in sources:
+        raise ValueError(f'Unknown source {source}, expected one of {sorted(sources)}')
+    bbox = tuple(float(c) for c in param('bbox').split(','))
+    if len(bbox) != 4 or not all(math.isfinite(c) for c in bbox) or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError('bbox must be west,south,east,north')
+    years = parse_range(param('years', '')) if param('years', '') else None
+    harms = tuple(sorted(set(param('harm', '').split(',')) - {''})) or None
+    unknown = set(harms or []) - set(HARM_CATEGORIES)
+    if unknown:
+        raise ValueError(f'Unknown harm {", ".join(sorted(unknown))}, expected one of {HARM_CATEGORIES}')
+    output_format = param('format', 'geojson')
+    if output_format not in FORMATS:
+        raise ValueError(f'Unknown format {output_format}, expected one of {list(FORMATS)}')
+    return source, bbox, years, harms, output_format
+
+
+# Answers bbox/year/harm queries over the indexes of one or more sources, over HTTP:
+#   GET /crashes?source=fars&bbox=-77.2,38.8,-76.9,39.0&years=2015-2020&harm=ped,bike&format=geojson
+#   GET /sources, GET /stats
+# Queries run on a thread pool so cached responses are served while others are computed; concurrent requests for the
+# same query share one computation.
+class QueryService:
+    def __init__(self, indexes: dict, cache_bytes=DEFAULT_CACHE_BYTES, max_results=MAX_RESULTS):
+        self.indexes = indexes
+        self.cache = LruCache(cache_bytes)
+        self.max_results = max_results
+        self.pending = {}
+
+    def render(self, query):
+        source, bbox, years, harms, output_format = query
+        index = self.indexes[source]
+        positions = index.positions(bbox, years, harms)
+        if len(positions) > self.max_results:
+            raise ValueError(f'{len(positions)} crashes match, more than the limit of {self.max_results}; '
+                             f'narrow the bbox or years')
+        return index.write_binary(positions) if output_format == 'binary' else index.write_geojson(positions)
+
+    def finish(self, query, future):
+        del self.pending[query]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(query, future.result())
+
+    async def crashes(self, query):
+        body = self.cache.get(query)
+        if body is not None:
+            return body
+        if query not in self.pending:
+            self.pending[query] = asyncio.get_running_loop().run_in_executor(None, self.render, query)
+            self.pending[query].add_done_callback(lambda future: self.finish(query, future))
+        return await self.pending[query]
+
+    def sources(self):
+        return {name: {k: index.meta.get(k) for k in ['rows', 'years', 'cell_size']}
+                for name, index in self.indexes.items()}
+
+    async def respond(self, method, target):
+        if method != 'GET':
+            return 405, 'application/json', json.dumps({'error': f'{method} not allowed'}).encode()
+        url = urlsplit(target)
+        try:
+            if url.path == '/crashes':
+                query = parse_query(parse_qs(url.query), self.indexes)
+                return 200, FORMATS[query[-1]], await self.crashes(query)
+            if url.path == '/sources':
+                return 200, 'application/json', json.dumps(self.sources()).encode()
+            if url.path == '/stats':
+                return 200, 'application/json', json.dumps(self.cache.stats()).encode()
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        return 404, 'application/json', json.dumps({'error': f'No such path {url.path}'}).encode()
+
+    # Serves HTTP/1.1 requests on one connection, keeping it open between requests unless the client closes it.
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip().lower()
+                keep_alive = headers.get('connection', 'keep-alive' if version == 'HTTP/1.1' else 'close') != 'close'
+                try:
+                    status, content_type, body = await self.respond(method, target)
+                except Exception as e:
+                    status, content_type, body = 500, 'application/json', json.dumps({'error': str(e)}).encode()
+                writer.write(f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\nAccess-Control-Allow-Origin: *\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+                writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await self.start(host, port)
+        print(f'Serving {", ".join(self.indexes)} on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from dc import DcApiDataInterface, DcRowDataGetter
+    from fars import FarsApiDataInterface, FarsRowDataGetter
+    from maryland import MarylandApiDataInterface, MarylandRowDataGetter
+
+    sources = {
+        'fars': (FarsApiDataInterface, FarsRowDataGetter),
+        'dc': (DcApiDataInterface, DcRowDataGetter),
+        'maryland': (MarylandApiDataInterface, MarylandRowDataGetter),
+    }
+    parser = argparse.ArgumentParser(description='Serves bbox/year/harm queries over the merged crash data.')
+    parser.add_argument('--sources', nargs='*', default=list(sources), choices=list(sources))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE)
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+
+    query_indexes = {}
+    for source_name in args.sources:
+        interface, getter = sources[source_name]
+        api = interface()
+        query_indexes[source_name] = load_index(api, getter(column_names=api.column_names), args.cell_size,
+                                                rebuild=args.rebuild)
+    asyncio.run(QueryService(query_indexes, cache_bytes=args.cache_bytes).serve(args.host, args.port))
@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Eviction scans the whole table, so it runs only once this fraction of `max_bytes` has been written, or of `ttl` has
+# passed, since the last one. The cache can outgrow `max_bytes` by as much in between.
+EVICTION_FRACTION = 0.1
+
+
+class ResponseCache:
+    def __init__(self, path: str = 'cache/responses.sqlite', ttl: float = None, max_bytes: int = None):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.unevicted_bytes = 0
+        self.last_eviction = time.time()
+        # sqlite3 connections can't be shared between threads or with forked processes, so each thread of each process
+        # opens its own.
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                               'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                               'created REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            # WAL lets readers proceed while another process or thread writes.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @staticmethod
+    def key(api, params):
+        normalized = {str(k): str(v) for k, v in (params or {}).items()}
+        return f'{api}?{json.dumps(normalized, sort_keys=True, separators=(",", ":"))}'
+
+    def min_created(self):
+        return time.time() - self.ttl if self.ttl else 0
+
+    def get(self, api, params):
+        return self.get_many(api, [params])[0]
+
+    def get_many(self, api, params_list, batch_size: int = 500):
+        keys = [self.key(api, params) for params in params_list]
+        found = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            rows = self.connection().execute(
+                f'SELECT key, value FROM responses WHERE created >= ? AND key IN ({",".join("?" * len(batch))})',
+                [self.min_created()] + batch)
+            found.update((key, json.loads(zlib.decompress(value))) for key, value in rows)
+        return [found.get(key) for key in keys]
+
+    def put(self, api, params, value):
+        self.put_many(api, [(params, value)])
+
+    def put_many(self, api, items):
+        now = time.time()
+        rows = []
+        for params, value in items:
+            compressed = zlib.compress(json.dumps(value).encode('utf-8'))
+            rows.append((self.key(api, params), compressed, len(compressed), now))
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO responses (key, value, size, created) VALUES (?, ?, ?, ?)',
+                                   rows)
+        self.unevicted_bytes += sum(row[2] for row in rows)
+        if (self.max_bytes and self.unevicted_bytes >= self.max_bytes * EVICTION_FRACTION) or \
+                (self.ttl and time.time() - self.last_eviction >= self.ttl * EVICTION_FRACTION):
+            self.evict()
+
+    def evict(self):
+        self.unevicted_bytes = 0
+        self.last_eviction = time.time()
+        with self.connection() as connection:
+            if self.ttl:
+                connection.execute('DELETE FROM responses WHERE created < ?', [self.min_created()])
+            if self.max_bytes:
+                # Drop the oldest entries beyond the newest `max_bytes` worth of responses.
+                connection.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    '  SELECT key FROM ('
+                    '    SELECT key, SUM(size) OVER (ORDER BY created DESC, key) AS total FROM responses'
+                    '  ) WHERE total > ?)', [self.max_bytes])
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+# Besides numpy dtypes, str and 'category', a Table's dtypes may declare DATETIME; unparseable dates become NaT.
+DATETIME = 'datetime'
+
+
+def is_text(dtype):
+    return dtype is str or dtype == 'category'
+
+
+def convert_column(values: pd.Series, dtype):
+    if dtype == DATETIME:
+        return pd.to_datetime(values, errors='coerce')
+    if is_text(dtype):
+        return values.astype(dtype)
+    dtype = np.dtype(dtype)
+    numeric = pd.to_numeric(values, errors='coerce')
+    if dtype.kind not in 'iu':
+        return numeric.astype(dtype)
+    info = np.iinfo(dtype)
+    if numeric.min() < info.min or numeric.max() > info.max:
+        raise ValueError(f'{values.name} has values outside the range of {dtype}')
+    if numeric.isnull().any():
+        # Integer dtypes can't hold NaN; use the smallest float that holds every value of the declared type.
+        return numeric.astype(np.float32 if dtype.itemsize <= 2 else np.float64)
+    return numeric.astype(dtype)
+
+
+# Converts every column declared in `dtypes` at once, leaving the others as they are.
+def apply_schema(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    return df.assign(**{c: convert_column(df[c], dtype) for c, dtype in dtypes.items() if c in df.columns})
+
+
+# The dtypes read_csv can apply itself without failing on missing or malformed values. Text is read as str even for
+# categoricals, since chunks read with their own categories would concatenate back to object columns.
+def read_csv_dtypes(dtypes: dict) -> dict:
+    return {c: str if is_text(dtype) else dtype for c, dtype in dtypes.items()
+            if is_text(dtype) or (dtype != DATETIME and np.dtype(dtype).kind == 'f')}
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
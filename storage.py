@@ -0,0 +1,163 @@
+import json
+import math
+import operator
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Metadata key listing columns of nested records (lists of dicts) stored as JSON text.
+JSON_COLUMNS_KEY = b'crash.json_columns'
+
+FILTER_OPERATORS = {
+    '=': operator.eq, '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'in': lambda values, v: values.isin(v), 'not in': lambda values, v: ~values.isin(v),
+}
+
+
+# Applies pyarrow-style filters, a list of (column, op, value) tuples that must all hold, to an in-memory frame.
+def apply_filters(df: pd.DataFrame, filters: list) -> pd.DataFrame:
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        values = df[column] if column in df.columns else pd.Series(df.index.get_level_values(column), index=df.index)
+        mask &= FILTER_OPERATORS[op](values, value)
+    return df[mask]
+
+
+class PickleStorage:
+    suffix = '.pkl'
+
+    def write(self, df: pd.DataFrame, path: str):
+        df.to_pickle(path)
+
+    def read(self, path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
+        return self.read_counted(path, columns, filters)[0]
+
+    # The frame and the number of bytes read to get it: a pickle is always read whole.
+    def read_counted(self, path: str, columns: list = None, filters: list = None):
+        df = pd.read_pickle(path)
+        if filters:
+            df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return df, os.path.getsize(path)
+
+
+def is_nested(values: pd.Series):
+    return any(isinstance(v, (list, dict)) for v in values)
+
+
+def decode_json(value):
+    return json.loads(value) if isinstance(value, str) else math.nan
+
+
+class ArrowStorage:
+    suffix = None
+    format = None
+
+    def __init__(self):
+        if pyarrow is None:
+            raise ValueError(f'{type(self).__name__} requires the pyarrow package')
+
+    def to_arrow(self, df: pd.DataFrame):
+        df = df.copy(deep=False)
+        json_columns = []
+        for column in df.columns[df.dtypes == object]:
+            values = df[column]
+            if is_nested(values):
+                # Arrow would turn NaN inside records into nulls; JSON text keeps records exactly as pandas had them.
+                df[column] = [json.dumps(v, default=str) if isinstance(v, (list, dict)) else None for v in values]
+                json_columns.append(column)
+            elif pd.api.types.infer_dtype(values, skipna=True).startswith('mixed'):
+                # read_csv can leave columns holding both numbers and strings, which arrow cannot store.
+                df[column] = values.map(str, na_action='ignore')
+        table = pyarrow.Table.from_pandas(df, preserve_index=True)
+        metadata = {**(table.schema.metadata or {}), JSON_COLUMNS_KEY: json.dumps(json_columns).encode()}
+        return table.replace_schema_metadata(metadata)
+
+    def read(self, path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
+        return self.read_counted(path, columns, filters)[0]
+
+    # Bytes of the columns that were read, after projection and pushdown.
+    def bytes_read(self, dataset, table, columns, expression):
+        return table.nbytes
+
+    def read_counted(self, path: str, columns: list = None, filters: list = None):
+        dataset = pyarrow.dataset.dataset(path, format=self.format)
+        metadata = dataset.schema.metadata or {}
+        if columns is not None:
+            # Index columns have to come along for to_pandas to rebuild the index.
+            pandas_metadata = json.loads(metadata.get(b'pandas', b'{}'))
+            index_columns = [c for c in pandas_metadata.get('index_columns', []) if isinstance(c, str)]
+            columns = [c for c in dataset.schema.names if c in set(columns) | set(index_columns)]
+        expression = pyarrow.parquet.filters_to_expression(filters) if filters else None
+        table = dataset.to_table(columns=columns, filter=expression)
+        df = table.to_pandas()
+        for column in json.loads(metadata.get(JSON_COLUMNS_KEY, b'[]')):
+            if column in df.columns:
+                df[column] = df[column].map(decode_json)
+        return df, self.bytes_read(dataset, table, columns, expression)
+
+
+class ParquetStorage(ArrowStorage):
+    suffix = '.parquet'
+    format = 'parquet'
+
+    # Small row groups keep min/max statistics selective enough for filters to skip most of a file.
+    def __init__(self, compression='zstd', row_group_size=1 << 16):
+        super(ParquetStorage, self).__init__()
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+    # Compressed size of the projected columns in the row groups whose statistics the filter doesn't rule out, which is
+    # what the reader fetches from the file.
+    def bytes_read(self, dataset, table, columns, expression):
+        names = set(dataset.schema.names if columns is None else columns)
+        total = 0
+        for fragment in dataset.get_fragments():
+            row_groups = fragment.split_by_row_group(expression) if expression is not None else [fragment]
+            metadata = fragment.metadata
+            for row_group_fragment in row_groups:
+                for row_group in row_group_fragment.row_groups:
+                    chunks = metadata.row_group(row_group.id)
+                    total += sum(chunks.column(i).total_compressed_size for i in range(chunks.num_columns)
+                                 if chunks.column(i).path_in_schema in names)
+        return total
+
+    def write(self, df: pd.DataFrame, path: str):
+        pyarrow.parquet.write_table(self.to_arrow(df), path, compression=self.compression,
+                                    row_group_size=self.row_group_size)
+
+
+class FeatherStorage(ArrowStorage):
+    suffix = '.feather'
+    format = 'feather'
+
+    def __init__(self, compression='zstd'):
+        super(FeatherStorage, self).__init__()
+        self.compression = compression
+
+    def write(self, df: pd.DataFrame, path: str):
+        pyarrow.feather.write_feather(self.to_arrow(df), path, compression=self.compression)
+
+
+STORAGES = {'pickle': PickleStorage, 'parquet': ParquetStorage, 'feather': FeatherStorage}
+# Fixed rather than picked by whether pyarrow is installed, so every machine reads and writes the same files. Parquet
+# and Feather, which need pyarrow>=10, are opt-in.
+DEFAULT_STORAGE = 'pickle'
+
+
+def get_storage(name: str = None):
+    if name is None:
+        name = DEFAULT_STORAGE
+    if name not in STORAGES:
+        raise ValueError(f'Unknown storage {name}, expected one of {", ".join(STORAGES)}')
+    return STORAGES[name]()
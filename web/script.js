@@ -32,6 +32,9 @@ function loadMetadata() {
         success: data => {
             metadata = data;
             metadata.filenames = new Set(metadata.filenames)
+            for (const level of metadata.levels || []) {
+                level.filenames = new Set(level.filenames)
+            }
             window.dispatchEvent(new CustomEvent("metadata-load"))
         }
     })
@@ -102,9 +105,8 @@ function onMarkerClick(e) {
     if (fullData.has(properties.get("id"))) {
         dispatchDetails(properties)
     } else {
-        let url = `data/${dataset}/data-${roundLatLongDown(e.lngLat.lat)}_${roundLatLongDown(e.lngLat.lng)}-full.json`
         $.ajax({
-            url: url,
+            url: detailsUrl(e.features[0].layer.source, properties.get("id")),
             properties: properties,
             success: function (data) {
                 mergeMaps(fullData, data)
@@ -114,6 +116,22 @@ function onMarkerClick(e) {
     }
 }
 
+// The cell tile a crash tile belongs to: the tile itself, or the cell of a year partition.
+function cellFilename(filename) {
+    let range = partitionRanges.get(filename)
+    return range ? filename.replace(`-${range[0]}_${range[1]}.json`, '.json') : filename
+}
+
+// Just the shard of the cell's details holding the crash, or the tile's whole `-full.json` for data without shards.
+function detailsUrl(filename, id) {
+    let cell = cellFilename(filename)
+    let shards = metadata.details && metadata.details.shards[cell]
+    if (!shards) {
+        return filename.replace(/\.json$/, '-full.json')
+    }
+    return cell.replace(/\.json$/, `-details/${fnv1a(id) % shards}.json`)
+}
+
 let currentHover = null
 
 function onMarkerHover(e) {
@@ -165,86 +183,193 @@ function dispatchDetails(properties) {
     $("#crash-tab").click()
 }
 
-function roundLatLongDown(latlong) {
-    let interval = metadata.latlong_interval
+function roundLatLongDown(latlong, interval = metadata.latlong_interval) {
     return Math.floor(latlong / interval) * interval;
 }
 
-function roundLatLongUp(latlong) {
-    let interval = metadata.latlong_interval
+function roundLatLongUp(latlong, interval = metadata.latlong_interval) {
     return Math.ceil(latlong / interval) * interval;
 }
 
 let loadedFiles = new Set()
+let clusterLayers = new Set()
+let clusterTiles = new Map()
+let partitionRanges = new Map()
+
+// The zoomed-out pyramid level covering the current zoom, or the individual crash tiles past the last level.
+function currentLevel() {
+    let zoom = map.getZoom()
+    let level = (metadata.levels || []).find(l => zoom < l.max_zoom)
+    return level || {
+        latlong_interval: metadata.latlong_interval,
+        directory: `data/${dataset}`,
+        filenames: metadata.filenames,
+        crashes: true,
+    }
+}
 
 function getNewData() {
+    let level = currentLevel()
+    clearOtherLevels(level)
+    let interval = level.latlong_interval
     let bounds = map.getBounds()
-    let south = roundLatLongDown(bounds.getSouth())
-    let north = roundLatLongUp(bounds.getNorth())
-    let west = roundLatLongDown(bounds.getWest())
-    let east = roundLatLongUp(bounds.getEast())
-    for (let lat = south; lat < north; lat += metadata.latlong_interval) {
-        for (let long = west; long < east; long += metadata.latlong_interval) {
-            let filename = `data/${dataset}/data-${lat}_${long}.json`
-            if (map.getSource(filename) || !metadata.filenames.has(filename)) {
+    let south = roundLatLongDown(bounds.getSouth(), interval)
+    let north = roundLatLongUp(bounds.getNorth(), interval)
+    let west = roundLatLongDown(bounds.getWest(), interval)
+    let east = roundLatLongUp(bounds.getEast(), interval)
+    for (let lat = south; lat < north; lat += interval) {
+        for (let long = west; long < east; long += interval) {
+            let filename = `${level.directory}/data-${lat}_${long}.json`
+            if (!level.filenames.has(filename)) {
                 continue;
             }
-            loadedFiles.add(filename)
-            map.addSource(filename, {
-                'type': 'geojson',
-                'data': filename,
-                'cluster': false,
-                'generateId': true,
-            });
-            map.addLayer({
-                id: filename,
-                type: 'circle',
-                source: filename,
-                'paint': {
-                    'circle-opacity': .8,
-                    'circle-color': [
-                        'match',
-                        ['get', 'harm'],
-                        'bike',
-                        '#fbb03b',
-                        'car',
-                        '#223b53',
-                        'ped',
-                        '#e55e5e',
-                        /* other */
-                        '#3bb2d0',
-                    ],
-                    'circle-radius': {
-                        stops: [[4, 1], [10, 3], [13, 6], [16, 8]]
-                    },
-                    'circle-stroke-width': [
-                        'case',
-                        ['boolean', ['feature-state', 'hover'], false,],
-                        2,
-                        0,
-                    ],
-                    'circle-stroke-color': [
-                        'match',
-                        ['get', 'harm'],
-                        'bike',
-                        '#fbb03b',
-                        'car',
-                        '#223b53',
-                        'ped',
-                        '#e55e5e',
-                        /* other */
-                        '#3bb2d0',
-                    ],
-                },
-            });
-            map.on('click', filename, onMarkerClick);
-            map.on('mousemove', filename, onMarkerHover);
-            map.on('mouseleave', filename, onMarkerUnhover);
-            setFilter(filename);
+            let files = level.crashes ? crashFiles(filename) : [filename]
+            for (const file of files) {
+                if (map.getSource(file)) {
+                    continue;
+                }
+                loadedFiles.add(file)
+                if (level.crashes) {
+                    addCrashLayer(file, file === filename)
+                } else {
+                    addClusterLayer(file, level)
+                }
+            }
         }
     }
 }
 
+// The year partitions of a cell that overlap the selected years, or the whole cell tile if it isn't partitioned.
+function crashFiles(cellFilename) {
+    if (!metadata.year_partitions) {
+        return [cellFilename]
+    }
+    let years = selectedYears()
+    return (metadata.year_partitions.cells[cellFilename] || [])
+        .filter(([start, end]) => start <= years.max && end >= years.min)
+        .map(([start, end]) => {
+            let filename = cellFilename.replace(/\.json$/, `-${start}_${end}.json`)
+            partitionRanges.set(filename, [start, end])
+            return filename
+        })
+}
+
+function addCrashLayer(filename, isCellTile) {
+    let binaryFormat = isCellTile && metadata.formats && metadata.formats.binary
+    map.addSource(filename, {
+        'type': 'geojson',
+        'data': binaryFormat ? {type: 'FeatureCollection', features: []} : filename,
+        'cluster': false,
+        'generateId': true,
+    });
+    if (binaryFormat) {
+        loadBinaryTile(filename, binaryFormat).then(data => {
+            let source = map.getSource(filename)
+            if (source) {
+                source.setData(data)
+            }
+        })
+    }
+    map.addLayer({
+        id: filename,
+        type: 'circle',
+        source: filename,
+        'paint': {
+            'circle-opacity': .8,
+            'circle-color': [
+                'match',
+                ['get', 'harm'],
+                'bike',
+                '#fbb03b',
+                'car',
+                '#223b53',
+                'ped',
+                '#e55e5e',
+                /* other */
+                '#3bb2d0',
+            ],
+            'circle-radius': {
+                stops: [[4, 1], [10, 3], [13, 6], [16, 8]]
+            },
+            'circle-stroke-width': [
+                'case',
+                ['boolean', ['feature-state', 'hover'], false,],
+                2,
+                0,
+            ],
+            'circle-stroke-color': [
+                'match',
+                ['get', 'harm'],
+                'bike',
+                '#fbb03b',
+                'car',
+                '#223b53',
+                'ped',
+                '#e55e5e',
+                /* other */
+                '#3bb2d0',
+            ],
+        },
+    });
+    map.on('click', filename, onMarkerClick);
+    map.on('mousemove', filename, onMarkerHover);
+    map.on('mouseleave', filename, onMarkerUnhover);
+    setFilter(filename);
+}
+
+function addClusterLayer(filename, level) {
+    clusterLayers.add(filename)
+    map.addSource(filename, {
+        'type': 'geojson',
+        'data': {type: 'FeatureCollection', features: []},
+        'cluster': false,
+        'generateId': true,
+    });
+    fetch(filename)
+        .then(response => response.json())
+        .then(data => {
+            if (map.getSource(filename)) {
+                clusterTiles.set(filename, {data: data, harms: level.harms})
+                setFilter(filename)
+            }
+        })
+    map.addLayer({
+        id: filename,
+        type: 'circle',
+        source: filename,
+        'paint': {
+            'circle-opacity': .6,
+            'circle-color': '#e55e5e',
+            'circle-stroke-width': [
+                'case',
+                ['boolean', ['feature-state', 'hover'], false,],
+                2,
+                0,
+            ],
+            'circle-stroke-color': '#e55e5e',
+        },
+    });
+    map.on('click', filename, e => map.easeTo({center: e.lngLat, zoom: level.max_zoom}));
+    map.on('mousemove', filename, onMarkerHover);
+    map.on('mouseleave', filename, onMarkerUnhover);
+    setFilter(filename);
+}
+
+function removeFile(file) {
+    map.removeLayer(file)
+    map.removeSource(file)
+    loadedFiles.delete(file)
+    clusterLayers.delete(file)
+    clusterTiles.delete(file)
+    partitionRanges.delete(file)
+}
+
+function clearOtherLevels(level) {
+    Array.from(loadedFiles)
+        .filter(file => file.substring(0, file.lastIndexOf('/')) !== level.directory)
+        .forEach(removeFile)
+}
+
 function clearSources(dataset) {
     let filesToRemove = new Set()
     loadedFiles.forEach(function (file) {
@@ -252,11 +377,7 @@ function clearSources(dataset) {
             filesToRemove.add(file)
         }
     });
-    filesToRemove.forEach(function (file) {
-        map.removeLayer(file)
-        map.removeSource(file)
-        loadedFiles.delete(file)
-    })
+    filesToRemove.forEach(removeFile)
 }
 
 function getCounts() {
@@ -264,6 +385,11 @@ function getCounts() {
     let fatality_count = 0
     let features = map.queryRenderedFeatures({layers: Array.from(loadedFiles)});
     features.forEach(function (f) {
+        if (clusterLayers.has(f.layer.id)) {
+            crash_count += f.properties.crashes
+            fatality_count += f.properties.fatalities
+            return
+        }
         crash_count++
         fatality_count += f.properties.num_fatalities
     });
@@ -271,11 +397,57 @@ function getCounts() {
 }
 
 const filters = {
-    "harm": new Set(["ped", "car", "bike", "other"])
+    "harm": new Set(["ped", "car", "bike", "other"]),
+    "years": {min: null, max: null},
+}
+
+function selectedYears() {
+    let years = filters["years"]
+    return {
+        min: years.min === null ? metadata.min_year : years.min,
+        max: years.max === null ? metadata.max_year : years.max,
+    }
+}
+
+// Sets each cluster's `crashes` and `fatalities` to its totals over the selected harms and years, summed from its
+// `totals` of flattened [year, harm index, crashes, fatalities] entries.
+function selectClusterTotals(filename) {
+    let tile = clusterTiles.get(filename)
+    if (!tile) {
+        return
+    }
+    let years = selectedYears()
+    for (const feature of tile.data.features) {
+        let totals = feature.properties.totals
+        let crashes = 0
+        let fatalities = 0
+        for (let i = 0; i < totals.length; i += 4) {
+            if (totals[i] >= years.min && totals[i] <= years.max && filters["harm"].has(tile.harms[totals[i + 1]])) {
+                crashes += totals[i + 2]
+                fatalities += totals[i + 3]
+            }
+        }
+        feature.properties.crashes = crashes
+        feature.properties.fatalities = fatalities
+    }
+    map.getSource(filename).setData(tile.data)
 }
 
 function setFilter(layer) {
-    map.setFilter(layer, ['in', ['get', 'harm'], ['literal', Array.from(filters["harm"])]]);
+    if (clusterLayers.has(layer)) {
+        selectClusterTotals(layer)
+        let crashes = ['coalesce', ['get', 'crashes'], 0]
+        map.setFilter(layer, ['>', crashes, 0]);
+        map.setPaintProperty(layer, 'circle-radius', ['interpolate', ['linear'], ['sqrt', crashes], 1, 3, 10, 12, 40, 30]);
+        return
+    }
+    let years = selectedYears()
+    map.setFilter(layer, [
+        'all',
+        ['in', ['get', 'harm'], ['literal', Array.from(filters["harm"])]],
+        ['>=', ['get', 'year'], years.min],
+        ['<=', ['get', 'year'], years.max],
+    ]);
 }
 
 $(".filter-button").on('click', (event) => {
@@ -294,6 +466,21 @@ $(".filter-button").on('click', (event) => {
     updateCount()
 });
 
+$(".year-input").on('change', () => {
+    let min = parseInt($("#min-year").val())
+    let max = parseInt($("#max-year").val())
+    filters["years"] = {min: isNaN(min) ? null : min, max: isNaN(max) ? null : max}
+    let years = selectedYears()
+    Array.from(partitionRanges)
+        .filter(([file, [start, end]]) => start > years.max || end < years.min)
+        .forEach(([file, _]) => removeFile(file))
+    loadedFiles.forEach(function (f) {
+        setFilter(f)
+    });
+    getNewData()
+    updateCount()
+});
+
 let dropdown = document.querySelector('.dropdown');
 dropdown.addEventListener('click', function (event) {
     event.stopPropagation();
@@ -302,6 +489,7 @@ dropdown.addEventListener('click', function (event) {
 
 function updateSource(element) {
     clearSources(dataset)
+    filters["years"] = {min: null, max: null}
     dataset = element.getAttribute('data-source')
     window.dispatchEvent(new CustomEvent("sources-load"))
     loadMetadata()
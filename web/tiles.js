@@ -0,0 +1,43 @@
+// Decoder for the packed binary tiles written by `write_binary_tile` in web_data.py.
+const BINARY_TILE_MAGIC = 'CRSH'
+const BINARY_TILE_HEADER_SIZE = 16
+
+function decodeBinaryTile(buffer, harms) {
+    let header = new DataView(buffer, 0, BINARY_TILE_HEADER_SIZE)
+    let magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+    if (magic !== BINARY_TILE_MAGIC) {
+        throw new Error(`Not a binary tile: ${magic}`)
+    }
+    let count = header.getUint32(8, true)
+    let idsLength = header.getUint32(12, true)
+
+    let offset = BINARY_TILE_HEADER_SIZE
+    let longitudes = new Int32Array(buffer, offset, count)
+    offset += 4 * count
+    let latitudes = new Int32Array(buffer, offset, count)
+    offset += 4 * count
+    let years = new Uint16Array(buffer, offset, count)
+    offset += 2 * count
+    let harmCodes = new Uint8Array(buffer, offset, count)
+    offset += count
+    let fatalities = new Uint8Array(buffer, offset, count)
+    offset += count
+    let ids = new TextDecoder().decode(new Uint8Array(buffer, offset, idsLength)).split('\n')
+
+    let features = new Array(count)
+    for (let i = 0; i < count; i++) {
+        features[i] = {
+            type: 'Feature',
+            geometry: {type: 'Point', coordinates: [longitudes[i] / 1e6, latitudes[i] / 1e6]},
+            properties: {id: ids[i], year: years[i], harm: harms[harmCodes[i]], num_fatalities: fatalities[i]},
+        }
+    }
+    return {type: 'FeatureCollection', features: features}
+}
+
+function loadBinaryTile(filename, format) {
+    let url = filename.replace(/\.json$/, format.suffix)
+    return fetch(url)
+        .then(response => response.arrayBuffer())
+        .then(buffer => decodeBinaryTile(buffer, format.harms))
+}
@@ -7,6 +7,15 @@ function mergeMaps(into, from) {
     }
 }
 
+// 32-bit FNV-1a hash of a string's UTF-8 bytes, matching `fnv1a_hashes` in web_data.py.
+function fnv1a(text) {
+    let hash = 0x811c9dc5
+    for (const byte of new TextEncoder().encode(text)) {
+        hash = Math.imul(hash ^ byte, 0x01000193) >>> 0
+    }
+    return hash
+}
+
 // From: https://davidwalsh.name/javascript-debounce-function
 //
 // Returns a function, that, as long as it continues to be invoked, will not
@@ -1,21 +1,53 @@
+import gzip
+import hashlib
+import inspect
 import json
 import math
 import os
+import shutil
+import struct
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from json.encoder import encode_basestring_ascii
 
 import geojson
+import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 
-WEB_BASE_DIR = 'web'
-DATA_BASE_DIR = 'data'
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+from child_tables import child_records, child_row_positions, child_tables, length_column, offset_column, take_rows, \
+    with_child_tables, with_record_columns
+from constants import ColumnNames, CrashCategory
+from instrumentation import RunReport, TileMetrics, file_size
+from pipeline import code_version
 
-@dataclass
-class ColumnNames:
-    latitude: str = 'LATITUDE'
-    longitude: str = 'LONGITUDE'
-    year: str = 'YEAR'
-    id: str = None
+WEB_BASE_DIR = 'web'
+DATA_BASE_DIR = 'data'
+HARM_CATEGORIES = [c.value for c in CrashCategory]
+WRITE_BUFFER_SIZE = 1 << 20
+BINARY_TILE_MAGIC = b'CRSH'
+BINARY_TILE_VERSION = 1
+BINARY_TILE_SUFFIX = '.bin'
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+# Bump when the tile output format changes, so incremental runs rewrite every tile.
+MANIFEST_VERSION = 3
+# Modules tile contents are computed by besides the row data getter's own; editing them, or the getter's, rewrites
+# every tile on the next incremental run.
+TILE_CODE_MODULES = ['child_tables', 'constants', 'web_data']
+# Average number of crashes per detail shard for sources that opt into shards; a cell's details are then split into
+# ceil(rows / size) shards.
+DETAIL_SHARD_SIZE = 32
+# Digits cluster centers are rounded to; 4 is about 10 m, well below the smallest cluster.
+CLUSTER_PRECISION = 4
+FNV_OFFSET_BASIS = 0x811c9dc5
+FNV_PRIME = 0x01000193
 
 
 @dataclass
@@ -34,6 +66,15 @@ class DataDescription:
     record_links: Links
 
 
+# One zoomed-out level of the tile pyramid: below `max_zoom` the viewer shows clusters of `cluster_interval`
+# degrees, split into tiles of `latlong_interval` degrees.
+@dataclass
+class PyramidLevel:
+    max_zoom: float
+    latlong_interval: float
+    cluster_interval: float
+
+
 class RowDataGetter:
     def __init__(self, column_names: ColumnNames = None):
         self.column_names = column_names
@@ -57,64 +98,555 @@ class RowDataGetter:
     def injuries(row):
         return {}
 
+    # Column-wise counterparts of the getters above, used by `iterate_and_save` in batch mode. Each takes
+    # the merged DataFrame with a default index and returns one value per row, in row order. The defaults
+    # fall back to the per-row getters, so a source only needs to override what it can vectorize.
+
+    def item_id_column(self, df):
+        return df[self.column_names.id].tolist() if self.column_names.id else [None] * len(df)
+
+    def category_column(self, df):
+        return [self.category(row) for _, row in df.iterrows()]
+
+    def num_fatalities_column(self, df):
+        return [self.num_fatalities(row) for _, row in df.iterrows()]
+
+    def num_vehicles_column(self, df):
+        return [self.num_vehicles(row) for _, row in df.iterrows()]
+
+    def injuries_column(self, df):
+        return [self.injuries(row) for _, row in df.iterrows()]
+
+
+# Flattens a column of per-row record lists into one DataFrame indexed by the position of the owning row.
+def explode_records(records: pd.Series, columns: list = None) -> pd.DataFrame:
+    exploded = records.reset_index(drop=True).explode()
+    exploded = exploded[exploded.map(lambda r: isinstance(r, dict))]
+    return pd.DataFrame(exploded.tolist(), index=exploded.index, columns=columns, dtype=object)
+
+
+# Child rows of each crash, indexed by the crash's position, from either a columnar child table or a column of record
+# lists.
+def child_rows(df: pd.DataFrame, name: str, columns: list = None) -> pd.DataFrame:
+    if name in child_tables(df):
+        return child_records(df, name, columns)
+    return explode_records(df[name], columns)
+
+
+def group_by_position(positions, keys, values, length):
+    grouped = [defaultdict(list) for _ in range(length)]
+    for position, key, value in zip(positions, keys, values):
+        grouped[position][key].append(value)
+    return grouped
+
+
+# Category of the most severely injured, most vulnerable person in each row. Takes `constants` enum members
+# indexed by row position.
+def most_severe_category(injury_types: pd.Series, person_types: pd.Series, length, default):
+    ranked = pd.DataFrame({
+        'position': injury_types.index,
+        'severity': [i.value.severity for i in injury_types],
+        'vulnerability': [p.value.vulnerability for p in person_types],
+        'category': [p.value.category.value for p in person_types],
+    })
+    ranked = ranked.sort_values(['position', 'severity', 'vulnerability'])
+    top = ranked.drop_duplicates('position', keep='last').set_index('position')['category']
+    return top.reindex(range(length), fill_value=default).tolist()
+
+
+# Encodes one column of JSON scalars the way `json.dump` would with its default settings.
+def encode_json_column(values):
+    if all(type(v) is str for v in values):
+        return [encode_basestring_ascii(v) for v in values]
+    if all(type(v) is int for v in values):
+        return [int.__repr__(v) for v in values]
+    if all(type(v) is float and math.isfinite(v) for v in values):
+        return [float.__repr__(v) for v in values]
+    return [json.dumps(v) for v in values]
+
+
+# Streams a GeoJSON FeatureCollection of points straight from column lists, without building `geojson` objects.
+# Output matches `json.dump(geojson.FeatureCollection(...))`: same key order and separators, and coordinates
+# rounded to `precision` digits like `geojson.Point`.
+def write_point_features(outfile, longitudes, latitudes, properties: dict, precision: int = 6):
+    coordinates = encode_json_column([round(c, precision) for c in longitudes]), \
+        encode_json_column([round(c, precision) for c in latitudes])
+    names = [encode_basestring_ascii(name) for name in properties]
+    columns = [encode_json_column(values) for values in properties.values()]
+
+    outfile.write('{"type": "FeatureCollection", "features": [')
+    separator = ''
+    for longitude, latitude, *values in zip(*coordinates, *columns):
+        encoded_properties = ', '.join(f'{name}: {value}' for name, value in zip(names, values))
+        outfile.write(f'{separator}{{"type": "Feature", "geometry": {{"type": "Point", "coordinates": '
+                      f'[{longitude}, {latitude}]}}, "properties": {{{encoded_properties}}}}}')
+        separator = ', '
+    outfile.write(']}')
+
+
+# Packed little-endian columnar tile, decoded by `decodeBinaryTile` in web/tiles.js. Layout:
+#   header: magic (4s), version (uint16), reserved (uint16), count (uint32), ids byte length (uint32)
+#   int32 longitude[count], int32 latitude[count] (micro-degrees), uint16 year[count],
+#   uint8 harm[count] (index into HARM_CATEGORIES), uint8 num_fatalities[count],
+#   newline-separated UTF-8 ids.
+def write_binary_tile(outfile, longitudes, latitudes, ids, years, harms, num_fatalities):
+    encoded_ids = '\n'.join(ids).encode('utf-8')
+    harm_codes = {h: i for i, h in enumerate(HARM_CATEGORIES)}
+    other = harm_codes[CrashCategory.OTHER.value]
+    fatalities = np.nan_to_num(np.asarray(num_fatalities, dtype=float))
+
+    outfile.write(struct.pack('<4sHHII', BINARY_TILE_MAGIC, BINARY_TILE_VERSION, 0, len(ids), len(encoded_ids)))
+    for coordinates in [longitudes, latitudes]:
+        outfile.write(np.round(np.asarray(coordinates, dtype=float) * 1e6).astype('<i4').tobytes())
+    outfile.write(np.asarray(years).astype('<u2').tobytes())
+    outfile.write(np.array([harm_codes.get(h, other) for h in harms], dtype=np.uint8).tobytes())
+    outfile.write(np.clip(fatalities, 0, 255).astype(np.uint8).tobytes())
+    outfile.write(encoded_ids)
+
+
+# 32-bit FNV-1a hashes of the UTF-8 ids, as computed by `fnv1a` in web/util.js to find a crash's detail shard.
+def fnv1a_hashes(ids) -> np.ndarray:
+    encoded = np.char.encode(np.asarray(ids, dtype=str), 'utf-8')
+    lengths = np.char.str_len(encoded)
+    data = encoded.view(np.uint8).reshape(len(encoded), encoded.dtype.itemsize)
+    hashes = np.full(len(encoded), FNV_OFFSET_BASIS, dtype=np.uint32)
+    for column in range(data.shape[1]):
+        hashes = np.where(column < lengths, (hashes ^ data[:, column]) * np.uint32(FNV_PRIME), hashes)
+    return hashes
+
+
+# Aggregates row data columns into one point per `cluster_interval` cell, at the mean location of its crashes. Its
+# `totals` property lists [year, harm, crashes, fatalities] for each year and harm (an index into HARM_CATEGORIES) it
+# has crashes of, flattened into one list, so the viewer can sum the selected years and harms.
+def cluster_columns(rows: pd.DataFrame, cluster_interval: float):
+    cells = np.floor(rows[['latitude', 'longitude']].to_numpy(dtype=float) / cluster_interval).astype(np.int64)
+    harm_codes = {h: i for i, h in enumerate(HARM_CATEGORIES)}
+    frame = pd.DataFrame({
+        'lat_cell': cells[:, 0],
+        'long_cell': cells[:, 1],
+        'latitude': rows['latitude'].to_numpy(dtype=float),
+        'longitude': rows['longitude'].to_numpy(dtype=float),
+        'year': rows['year'].to_numpy(dtype=np.int64),
+        'harm': rows['harm'].map(harm_codes).fillna(harm_codes[CrashCategory.OTHER.value]).to_numpy(dtype=np.int64),
+        'num_fatalities': np.nan_to_num(rows['num_fatalities'].to_numpy(dtype=float)).astype(np.int64),
+    })
+    centers = frame.groupby(['lat_cell', 'long_cell'])[['latitude', 'longitude']].mean()
+    totals = frame.groupby(['lat_cell', 'long_cell', 'year', 'harm'])['num_fatalities'].agg(['size', 'sum'])
+    # Groups come sorted by cell, so each cluster's totals are one contiguous run of rows.
+    lengths = totals.groupby(level=['lat_cell', 'long_cell']).size().to_numpy()
+    values = totals.reset_index()[['year', 'harm', 'size', 'sum']].to_numpy(dtype=np.int64).ravel()
+    properties = {'totals': [t.tolist() for t in np.split(values, np.cumsum(lengths * 4)[:-1])]}
+    return centers['longitude'].tolist(), centers['latitude'].tolist(), properties
+
+
+# Writes a precompressed sibling (`.gz`, `.br`) of `path` for each encoding.
+def compress_file(path, encodings):
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    for encoding in encodings:
+        if encoding == 'gzip':
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        else:
+            compressed = brotli.compress(data, quality=11)
+        with open(path + COMPRESSED_SUFFIXES[encoding], 'wb') as outfile:
+            outfile.write(compressed)
+
+
+class GridCells:
+    def __init__(self, cells: np.ndarray, intervals: list):
+        self.cells = cells
+        self.intervals = list(intervals)
+
+    @staticmethod
+    def assign(df, column_names: ColumnNames, intervals: list):
+        latlong = df[[column_names.latitude, column_names.longitude]].to_numpy(dtype=float)
+        # Shape (rows, intervals, 2): the floored lat/long cell index of every row at every interval.
+        cells = np.floor(latlong[:, np.newaxis, :] / np.array(intervals, dtype=float)[np.newaxis, :, np.newaxis])
+        return GridCells(cells.astype(np.int64), intervals)
+
+    def groups(self, interval):
+        cells = self.cells[:, self.intervals.index(interval), :]
+        indices = pd.DataFrame(cells, columns=['lat', 'long']).groupby(['lat', 'long']).indices
+        named = {f'{int(lat) * interval}_{int(long) * interval}': positions
+                 for (lat, long), positions in indices.items()}
+        for name in sorted(named):
+            yield name, named[name]
+
 
 class WebDataGenerator:
-    def __init__(self, row_data_getter: RowDataGetter, column_names: ColumnNames, data_description: DataDescription):
+    def __init__(self, row_data_getter: RowDataGetter, column_names: ColumnNames, data_description: DataDescription,
+                 binary_tiles: bool = False, compression: list = None, pyramid: list = None,
+                 year_partition_size: int = None, report: RunReport = None,
+                 detail_shard_size: int = None):
         self.column_names = column_names
         self.row_data_getter = row_data_getter
         self.data_description = data_description
+        self.binary_tiles = binary_tiles
+        self.pyramid = sorted(pyramid or [], key=lambda level: level.max_zoom)
+        self.year_partition_size = year_partition_size
+        self.detail_shard_size = detail_shard_size
+        self.report = report or RunReport()
+        self.compression = list(compression or [])
+        for encoding in self.compression:
+            if encoding not in COMPRESSED_SUFFIXES:
+                raise ValueError(f'Unknown compression {encoding}, expected one of {list(COMPRESSED_SUFFIXES)}')
+            if encoding == 'br' and brotli is None:
+                raise ValueError('Brotli compression requires the Brotli package')
         self.data_dir = f'data/{data_description.state}'
         self.web_data_dir = f'{WEB_BASE_DIR}/{self.data_dir}'
         if not os.path.exists(self.web_data_dir):
             os.makedirs(self.web_data_dir)
 
-    def iterate_and_save(self, df, latlong_interval: int = 1):
-        grouped = df.groupby(
-            df[[self.column_names.latitude, self.column_names.longitude]].agg(
-                lambda ys: '_'.join([str(math.floor(y / latlong_interval) * latlong_interval) for y in ys]), axis=1))
-
-        filenames = []
-        for name, group in grouped:
-            groupdf = group.reset_index()
-
-            geojson_items = []
-            items_details = {}
-            for index, row in groupdf.iterrows():
-                item_id = str(self.row_data_getter.item_id(row))
-                year = int(row[self.column_names.year])
-                properties = {
-                    'id': item_id,
-                    'year': year,
-                    'harm': self.row_data_getter.category(row),
-                    'num_fatalities': self.row_data_getter.num_fatalities(row),
-                }
-                details = {
-                    'year': year,
-                    'num_vehicles': self.row_data_getter.num_vehicles(row),
-                }
-                details.update(self.row_data_getter.injuries(row))
-                geojson_items.append(
-                    geojson.Feature(geometry=geojson.Point((row[self.column_names.longitude], row[self.column_names.latitude])), properties=properties))
-
-                items_details[item_id] = details
-
-            filename_geojson = f'{self.data_dir}/data-{name}.json'
-            with open(f'{WEB_BASE_DIR}/{filename_geojson}', 'w') as outfile:
+    def row_data_columns(self, df):
+        df = with_child_tables(df.reset_index(), child_tables(df))
+        getter = self.row_data_getter
+        return pd.DataFrame({
+            'id': [str(i) for i in getter.item_id_column(df)],
+            'year': df[self.column_names.year].astype(int).tolist(),
+            'harm': getter.category_column(df),
+            'num_fatalities': getter.num_fatalities_column(df),
+            'num_vehicles': getter.num_vehicles_column(df),
+            'injuries': getter.injuries_column(df),
+            'longitude': df[self.column_names.longitude].tolist(),
+            'latitude': df[self.column_names.latitude].tolist(),
+        }, dtype=object)
+
+    # Just the columns clusters need, without the ids, vehicle counts and injuries only crash tiles show.
+    def cluster_row_columns(self, df):
+        df = with_child_tables(df.reset_index(), child_tables(df))
+        getter = self.row_data_getter
+        return pd.DataFrame({
+            'year': df[self.column_names.year].astype(int).tolist(),
+            'harm': getter.category_column(df),
+            'num_fatalities': getter.num_fatalities_column(df),
+            'longitude': df[self.column_names.longitude].tolist(),
+            'latitude': df[self.column_names.latitude].tolist(),
+        }, dtype=object)
+
+    @staticmethod
+    def tile_details(group):
+        items_details = {}
+        for item_id, year, num_vehicles, injuries in zip(
+                group['id'].tolist(), group['year'].tolist(), group['num_vehicles'].tolist(),
+                group['injuries'].tolist()):
+            details = {
+                'year': year,
+                'num_vehicles': num_vehicles,
+            }
+            details.update(injuries)
+            items_details[item_id] = details
+        return items_details
+
+    @staticmethod
+    def write_features(outfile, group):
+        write_point_features(outfile, group['longitude'].tolist(), group['latitude'].tolist(), {
+            'id': group['id'].tolist(),
+            'year': group['year'].tolist(),
+            'harm': group['harm'].tolist(),
+            'num_fatalities': group['num_fatalities'].tolist(),
+        })
+
+    def tile_items_by_row(self, group):
+        groupdf = group.reset_index()
+
+        geojson_items = []
+        items_details = {}
+        for index, row in groupdf.iterrows():
+            item_id = str(self.row_data_getter.item_id(row))
+            year = int(row[self.column_names.year])
+            properties = {
+                'id': item_id,
+                'year': year,
+                'harm': self.row_data_getter.category(row),
+                'num_fatalities': self.row_data_getter.num_fatalities(row),
+            }
+            details = {
+                'year': year,
+                'num_vehicles': self.row_data_getter.num_vehicles(row),
+            }
+            details.update(self.row_data_getter.injuries(row))
+            geojson_items.append(
+                geojson.Feature(geometry=geojson.Point((row[self.column_names.longitude], row[self.column_names.latitude])), properties=properties))
+
+            items_details[item_id] = details
+        return geojson_items, items_details
+
+    @staticmethod
+    def write_binary(outfile, group):
+        write_binary_tile(outfile, group['longitude'].tolist(), group['latitude'].tolist(), group['id'].tolist(),
+                          group['year'].tolist(), group['harm'].tolist(), group['num_fatalities'].tolist())
+
+    def write_tile_json(self, stem, group, batch: bool = True, full: bool = True):
+        with open(f'{WEB_BASE_DIR}/{self.data_dir}/{stem}.json', 'w', buffering=WRITE_BUFFER_SIZE) as outfile:
+            if batch:
+                self.write_features(outfile, group)
+                items_details = self.tile_details(group)
+            else:
+                geojson_items, items_details = self.tile_items_by_row(group)
                 json.dump(geojson.FeatureCollection(features=geojson_items), outfile)
-            filenames.append(filename_geojson)
-            filename_full = f'{self.data_dir}/data-{name}-full.json'
-            with open(f'{WEB_BASE_DIR}/{filename_full}', 'w') as outfile:
+        if full:
+            with open(f'{WEB_BASE_DIR}/{self.data_dir}/{stem}-full.json', 'w') as outfile:
                 json.dump(items_details, outfile)
+        return items_details
+
+    def detail_dir(self, name):
+        return f'{self.data_dir}/data-{name}-details'
+
+    def detail_shards(self, rows):
+        return max(1, math.ceil(rows / self.detail_shard_size)) if self.detail_shard_size else 0
+
+    def detail_files(self, name, rows):
+        return [f'{self.detail_dir(name)}/{shard}.json' for shard in range(self.detail_shards(rows))]
+
+    # Splits a cell's details into shards by a hash of the crash id, so showing one crash fetches only its shard.
+    def write_detail_shards(self, name, items_details, rows):
+        shards = [{} for _ in range(self.detail_shards(rows))]
+        ids = list(items_details)
+        for item_id, shard in zip(ids, (fnv1a_hashes(ids) % len(shards)).tolist()):
+            shards[shard][item_id] = items_details[item_id]
+        os.makedirs(f'{WEB_BASE_DIR}/{self.detail_dir(name)}', exist_ok=True)
+        for filename, details in zip(self.detail_files(name, rows), shards):
+            with open(f'{WEB_BASE_DIR}/{filename}', 'w') as outfile:
+                json.dump(details, outfile)
+
+    # Aligned (start, end) year ranges of `year_partition_size` years that contain any of `years`.
+    def year_partitions(self, years):
+        if not self.year_partition_size:
+            return []
+        size = self.year_partition_size
+        starts = np.unique(np.asarray(years, dtype=np.int64) // size * size)
+        return [(int(start), int(start) + size - 1) for start in starts]
+
+    def save_tile(self, name, group, batch: bool = True):
+        start_time = time.perf_counter()
+        partitions = self.year_partitions(group['year'] if batch else [])
+        items_details = self.write_tile_json(f'data-{name}', group, batch)
+        if self.detail_shard_size:
+            self.write_detail_shards(name, items_details, len(group))
+        for start, end in partitions:
+            partition = group[(group['year'] >= start) & (group['year'] <= end)]
+            # With shards, details are fetched from the cell's shards, never from a partition's `-full.json`.
+            self.write_tile_json(f'data-{name}-{start}_{end}', partition, batch, full=not self.detail_shard_size)
+        if self.binary_tiles:
+            with open(f'{WEB_BASE_DIR}/{self.data_dir}/data-{name}{BINARY_TILE_SUFFIX}', 'wb') as outfile:
+                self.write_binary(outfile, group)
+        files = self.tile_files(name, partitions) + self.detail_files(name, len(group))
+        return TileMetrics(name=name, rows=len(group), seconds=time.perf_counter() - start_time,
+                           bytes_written=sum(file_size(f'{WEB_BASE_DIR}/{f}') for f in files))
+
+    # Yields each tile's metrics once its files are written, in submission order.
+    def save_tiles(self, tiles, batch: bool = True, workers: int = 1):
+        if workers <= 1:
+            for name, group in tiles:
+                yield self.save_tile(name, group, batch)
+            return
+
+        # Tiles are submitted lazily and at most `2 * workers` are in flight, so only those groups' rows are
+        # held (and pickled) at any time.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for name, group in tiles:
+                pending.append(executor.submit(self.save_tile, name, group, batch))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            for future in pending:
+                yield future.result()
+
+    def tile_files(self, name, partitions=()):
+        files = [f'{self.data_dir}/data-{name}.json', f'{self.data_dir}/data-{name}-full.json']
+        for start, end in partitions:
+            files.append(f'{self.data_dir}/data-{name}-{start}_{end}.json')
+            if not self.detail_shard_size:
+                files.append(f'{self.data_dir}/data-{name}-{start}_{end}-full.json')
+        if self.binary_tiles:
+            files.append(f'{self.data_dir}/data-{name}{BINARY_TILE_SUFFIX}')
+        return files
+
+    def output_files(self, name, partitions=()):
+        files = self.tile_files(name, partitions)
+        return files + [f + COMPRESSED_SUFFIXES[e] for f in files for e in self.compression]
+
+    def compressed_sizes(self, filenames):
+        return {
+            f: {'identity': os.path.getsize(f'{WEB_BASE_DIR}/{f}'),
+                **{e: os.path.getsize(f'{WEB_BASE_DIR}/{f}{COMPRESSED_SUFFIXES[e]}') for e in self.compression}}
+            for f in filenames
+        }
+
+    def manifest_file(self):
+        return f'{self.web_data_dir}/tile-manifest.json'
+
+    def code_version(self):
+        modules = {m.__name__: m for m in [sys.modules[name] for name in TILE_CODE_MODULES] + [
+            inspect.getmodule(cls) for cls in type(self.row_data_getter).__mro__ if cls is not object]}
+        return code_version(*[modules[name] for name in sorted(modules)])
+
+    def output_options(self, latlong_interval):
+        return {'version': MANIFEST_VERSION, 'code': self.code_version(), 'latlong_interval': latlong_interval,
+                'binary_tiles': self.binary_tiles, 'compression': self.compression,
+                'year_partition_size': self.year_partition_size, 'detail_shard_size': self.detail_shard_size,
+                'pyramid': [vars(level) for level in self.pyramid]}
+
+    def read_manifest(self, options):
+        try:
+            with open(self.manifest_file()) as infile:
+                manifest = json.load(infile)
+        except (IOError, ValueError):
+            return {}
+        return manifest if manifest.get('options') == options else {}
+
+    @staticmethod
+    def row_hashes(df, index=True):
+        if len(df.columns) == 0 and not index:
+            return np.zeros(len(df), dtype=np.uint64)
+        # Object columns hold per-crash record lists, which aren't hashable; hash their text form instead.
+        df = df.assign(**{c: df[c].astype(str) for c in df.select_dtypes(object).columns})
+        return pd.util.hash_pandas_object(df, index=index).to_numpy()
+
+    def tile_hashes(self, df, groups):
+        tables = child_tables(df)
+        # Offsets move whenever an earlier crash gains or loses children, so hash the child rows themselves instead.
+        row_hashes = self.row_hashes(df.drop(columns=[offset_column(name) for name in tables]))
+        child_hashes = {name: self.row_hashes(child, index=False) for name, child in tables.items()}
+        hashes = {}
+        for name, positions in groups:
+            tile_hash = hashlib.sha1(row_hashes[positions].tobytes())
+            for table_name, table_hashes in child_hashes.items():
+                _, rows = child_row_positions(df[offset_column(table_name)].to_numpy()[positions],
+                                              df[length_column(table_name)].to_numpy()[positions])
+                tile_hash.update(table_hashes[rows].tobytes())
+            hashes[name] = tile_hash.hexdigest()
+        return hashes
+
+    def is_unchanged(self, name, tile_hash, previous_hashes, partitions=(), rows=0):
+        details = self.detail_files(name, rows)
+        files = self.output_files(name, partitions) + details + [
+            f + COMPRESSED_SUFFIXES[e] for f in details for e in self.compression]
+        return previous_hashes.get(name) == tile_hash and all(os.path.exists(f'{WEB_BASE_DIR}/{f}') for f in files)
+
+    def remove_tile(self, name, partitions=()):
+        for filename in self.output_files(name, partitions):
+            if os.path.exists(f'{WEB_BASE_DIR}/{filename}'):
+                os.remove(f'{WEB_BASE_DIR}/{filename}')
+        shutil.rmtree(f'{WEB_BASE_DIR}/{self.detail_dir(name)}', ignore_errors=True)
+
+    def levels_exist(self, levels):
+        return bool(levels) and all(os.path.exists(f'{WEB_BASE_DIR}/{f}{suffix}') for level in levels
+                                    for f in level['filenames']
+                                    for suffix in [''] + [COMPRESSED_SUFFIXES[e] for e in self.compression])
+
+    def save_pyramid(self, rows):
+        levels = []
+        for index, level in enumerate(self.pyramid):
+            level_dir = f'{self.data_dir}/level-{index}'
+            # Levels are always rebuilt in full, so drop tiles of cells that no longer have data.
+            shutil.rmtree(f'{WEB_BASE_DIR}/{level_dir}', ignore_errors=True)
+            os.makedirs(f'{WEB_BASE_DIR}/{level_dir}')
+
+            filenames = []
+            grid_cells = GridCells.assign(rows, ColumnNames(latitude='latitude', longitude='longitude'),
+                                          [level.latlong_interval])
+            for name, positions in grid_cells.groups(level.latlong_interval):
+                longitudes, latitudes, properties = cluster_columns(rows.iloc[positions], level.cluster_interval)
+                filename = f'{level_dir}/data-{name}.json'
+                with open(f'{WEB_BASE_DIR}/{filename}', 'w', buffering=WRITE_BUFFER_SIZE) as outfile:
+                    write_point_features(outfile, longitudes, latitudes, properties, precision=CLUSTER_PRECISION)
+                if self.compression:
+                    compress_file(f'{WEB_BASE_DIR}/{filename}', self.compression)
+                filenames.append(filename)
+            levels.append({
+                'max_zoom': level.max_zoom,
+                'latlong_interval': level.latlong_interval,
+                'cluster_interval': level.cluster_interval,
+                'directory': level_dir,
+                'filenames': filenames,
+                'harms': HARM_CATEGORIES,
+            })
+        return levels
+
+    def iterate_and_save(self, df, latlong_interval: int = 1, batch: bool = True, grid_cells: GridCells = None,
+                         workers: int = 1, incremental: bool = False):
+        if (self.binary_tiles or self.pyramid or self.year_partition_size) and not batch:
+            raise ValueError('Binary tiles, pyramid levels and year partitions are only written in batch mode')
+        if grid_cells is None or latlong_interval not in grid_cells.intervals:
+            grid_cells = GridCells.assign(df, self.column_names, [latlong_interval])
+        groups = list(grid_cells.groups(latlong_interval))
+        years = pd.to_numeric(df.reset_index()[self.column_names.year], errors='coerce')
+        partitions = {name: self.year_partitions(years.to_numpy()[positions]) for name, positions in groups}
+        stage = f'web/{self.data_description.state}'
+
+        if incremental:
+            # Only cells whose input rows hash differently from the last run (or whose files are missing) are
+            # rebuilt; row data is computed for just those cells' rows.
+            options = self.output_options(latlong_interval)
+            with self.report.stage(f'{stage}/hash'):
+                hashes = self.tile_hashes(df, groups)
+                self.report.count(rows_in=len(df))
+            previous = self.read_manifest(options)
+            previous_hashes = previous.get('tiles', {})
+            previous_partitions = previous.get('partitions', {})
+            changed = [(n, p) for n, p in groups
+                       if not self.is_unchanged(n, hashes[n], previous_hashes, partitions[n], len(p))]
+            print(f'Rebuilding {len(changed)} of {len(groups)} tiles...')
+            removed = previous_hashes.keys() - hashes.keys()
+            for name in removed:
+                self.remove_tile(name, previous_partitions.get(name, []))
+            # A changed cell may have lost year partitions; drop them before it is rewritten.
+            for name, _ in changed:
+                self.remove_tile(name, previous_partitions.get(name, []))
+            selected = np.concatenate([p for _, p in changed]) if changed else np.array([], dtype=np.int64)
+            df_changed = take_rows(df, selected)
+            bounds = np.cumsum([0] + [len(p) for _, p in changed])
+            changed = [(n, np.arange(start, end)) for (n, _), start, end in zip(changed, bounds[:-1], bounds[1:])]
+        else:
+            df_changed, changed = df, groups
+
+        rows = None
+        if changed:
+            with self.report.stage(f'{stage}/rows'):
+                rows = self.row_data_columns(df_changed) if batch else with_record_columns(df_changed)
+                self.report.count(rows_in=len(df_changed), rows_out=len(rows))
+            tiles = ((name, rows.iloc[positions]) for name, positions in changed)
+            tile_metrics = []
+            # Compression runs on a thread pool (zlib and brotli release the GIL) while later tiles are written.
+            with self.report.stage(f'{stage}/tiles'), ThreadPoolExecutor(max_workers=os.cpu_count()) as compressor:
+                compressions = []
+                for tile in self.save_tiles(tiles, batch=batch, workers=workers):
+                    tile_metrics.append(tile)
+                    files = self.tile_files(tile.name, partitions[tile.name]) + self.detail_files(tile.name, tile.rows)
+                    compressions += [compressor.submit(compress_file, f'{WEB_BASE_DIR}/{f}', self.compression)
+                                     for f in (files if self.compression else [])]
+                for compression in compressions:
+                    compression.result()
+                self.report.count(rows_in=len(rows), rows_out=sum(t.rows for t in tile_metrics),
+                                  bytes_written=sum(t.bytes_written for t in tile_metrics))
+            self.report.merge(tiles=tile_metrics)
+        filenames = [self.tile_files(name)[0] for name, _ in groups]
+
+        levels = []
+        if self.pyramid and incremental and not changed and not removed and self.levels_exist(previous.get('levels')):
+            # No cell changed, so neither did any cluster.
+            levels = previous['levels']
+            self.report.skip(f'{stage}/pyramid')
+        elif self.pyramid:
+            # Clusters aggregate every crash, so they need the cluster columns of the whole frame, not just of the
+            # changed cells.
+            with self.report.stage(f'{stage}/pyramid'):
+                whole_frame = rows is not None and len(changed) == len(groups)
+                cluster_rows = rows if whole_frame else self.cluster_row_columns(df)
+                levels = self.save_pyramid(cluster_rows)
+                self.report.count(rows_in=len(cluster_rows))
+
+        if incremental:
+            with open(self.manifest_file(), 'w') as outfile:
+                json.dump({'options': options, 'tiles': hashes, 'partitions': partitions, 'levels': levels}, outfile)
 
-        df = df.reset_index()
-        for col in [self.column_names.year]:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
         metadata = {
             'title': self.data_description.title,
             'source': self.data_description.source,
             'latlong_interval': latlong_interval,
-            'min_year': int(df[self.column_names.year].min()),
-            'max_year': int(df[self.column_names.year].max()),
+            'min_year': int(years.min()),
+            'max_year': int(years.max()),
             'filenames': filenames,
             'record_links': {
                 'id_splitter': self.data_description.record_links.id_splitter,
@@ -123,7 +655,40 @@ class WebDataGenerator:
                 'vehicle_format': self.data_description.record_links.vehicle_format,
             }
         }
+        # The crash tiles in `filenames` serve zooms from the last level's `max_zoom` on.
+        if levels:
+            metadata['levels'] = levels
+        # Cell tiles in `filenames` are still written in full; clients that know about partitions fetch
+        # `data-{cell}-{start}_{end}.json` for just the selected years instead.
+        if self.year_partition_size:
+            metadata['year_partitions'] = {
+                'size': self.year_partition_size,
+                'cells': {self.tile_files(name)[0]: partitions[name] for name, _ in groups},
+            }
+        # Clients that don't know about `details` keep loading each cell's whole `-full.json` file.
+        if self.detail_shard_size:
+            metadata['details'] = {
+                'shard_size': self.detail_shard_size,
+                'shards': {self.tile_files(name)[0]: self.detail_shards(len(positions)) for name, positions in groups},
+            }
+        # Clients that don't know about `formats` keep loading the JSON tiles listed in `filenames`.
+        if self.binary_tiles:
+            metadata['formats'] = {
+                'binary': {'suffix': BINARY_TILE_SUFFIX, 'version': BINARY_TILE_VERSION, 'harms': HARM_CATEGORIES},
+            }
+        if self.compression:
+            metadata['compression'] = {
+                'encodings': self.compression,
+                'suffixes': {e: COMPRESSED_SUFFIXES[e] for e in self.compression},
+                # Everything served compressed: tiles, their detail shards and the pyramid levels.
+                'sizes': self.compressed_sizes(
+                    [f for name, positions in groups
+                     for f in self.tile_files(name, partitions[name]) + self.detail_files(name, len(positions))] +
+                    [f for level in levels for f in level['filenames']]),
+            }
 
         with open(f'{self.web_data_dir}/file-metadata.json', 'w') as outfile:
             json.dump(metadata, outfile)
+        if self.compression:
+            compress_file(f'{self.web_data_dir}/file-metadata.json', self.compression)
 